@@ -1,80 +1,88 @@
 import logging
-import os
-from pathlib import Path
 from typing import Dict, Iterable, Optional, Tuple
 
 import requests
-from dotenv import load_dotenv
-from flask import Flask, jsonify, request
-from common.storage import storage
-
-load_dotenv()
+from flask import Blueprint, Flask, Response, jsonify, request
+
+from app.media import MEDIA_STATE_KIND, media_forwarder, media_kind, media_payload
+from common.config import SystemPrompt, get_config, install_reload_signal
+from common.llm import get_llm
+from common.metrics import (
+    CONTENT_TYPE,
+    REGISTRY,
+    WEBHOOK_BYTES,
+    WEBHOOK_ERRORS,
+    WEBHOOK_MESSAGES,
+    WEBHOOK_SECONDS,
+    timed,
+    track_call,
+)
+from common.profiler import (
+    DEFAULT_INTERVAL_MS,
+    TOKEN_HEADER as PROFILER_TOKEN_HEADER,
+    ProfilerBusy,
+    authorized,
+    load_profile,
+    profiler_enabled,
+    start_profile,
+)
+from common.storage import get_storage
+from common.tracing import (
+    TRACE_HEADER,
+    TRACE_ID_HEADER,
+    TRACE_TOKEN_HEADER,
+    parse_trace_header,
+    should_sample,
+    span,
+    start_trace,
+    trace_authorized,
+)
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+webhook = Blueprint("webhook", __name__)
 WHATSAPP_CHANNEL = "whatsapp"
 
-WA_TOKEN = os.getenv("WA_TOKEN")
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
-WA_VERIFY_TOKEN = os.getenv("WA_VERIFY_TOKEN", "change_me")
-WA_PHONE_NUMBER_ID = os.getenv("WA_PHONE_NUMBER_ID")
-
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "z-ai/glm-4.5-air:free")
-OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
-OPENROUTER_SYSTEM_PROMPT_FILE = os.getenv("OPENROUTER_SYSTEM_PROMPT_FILE", "system_prompt.txt")
-OPENROUTER_REFERRER = os.getenv("OPENROUTER_REFERRER", "https://example.com")
-OPENROUTER_TITLE = os.getenv("OPENROUTER_TITLE", "WhatsAppTelegramBridge")
-ENABLE_AI_AUTOREPLY = os.getenv("ENABLE_AI_AUTOREPLY", "true").lower() not in {"0", "false", "no"}
-
+DEFAULT_OPENROUTER_MODEL = "z-ai/glm-4.5-air:free"
+DEFAULT_TELEGRAM_API_URL = "https://api.telegram.org"
+DEFAULT_GRAPH_API_URL = "https://graph.facebook.com/v19.0"
 DEFAULT_SYSTEM_PROMPT = (
     "Ты виртуальный ассистент компании, отвечаешь уважительно, кратко и по делу. "
     "Если не знаешь ответа — уточни детали."
 )
 
 
-def _load_system_prompt() -> str:
-    prompt_env = os.getenv("OPENROUTER_SYSTEM_PROMPT")
-    if prompt_env:
-        return prompt_env.strip()
+def system_prompt() -> SystemPrompt:
+    return get_config().system_prompt(DEFAULT_SYSTEM_PROMPT)
+
+
+def ai_autoreply_enabled() -> bool:
+    return get_config().flag("ENABLE_AI_AUTOREPLY")
 
-    path = Path(OPENROUTER_SYSTEM_PROMPT_FILE)
-    try:
-        text = path.read_text(encoding="utf-8").strip()
-        if text:
-            return text
-        logger.warning("System prompt file %s is empty; falling back to default.", path)
-    except FileNotFoundError:
-        logger.warning("System prompt file %s not found; using default prompt.", path)
-    except OSError as exc:
-        logger.warning("Failed to read system prompt file %s: %s", path, exc)
 
-    return DEFAULT_SYSTEM_PROMPT
+def validate_config() -> None:
+    required_env = ["TELEGRAM_BOT_TOKEN"]
+    if ai_autoreply_enabled():
+        required_env += ["WA_TOKEN", "WA_PHONE_NUMBER_ID", "OPENROUTER_API_KEY"]
+    get_config().require(*required_env)
 
 
-OPENROUTER_SYSTEM_PROMPT = _load_system_prompt()
+def media_forwarding_enabled() -> bool:
+    return get_config().flag("ENABLE_MEDIA_FORWARDING")
 
-required_env = {
-    "TELEGRAM_BOT_TOKEN": TELEGRAM_BOT_TOKEN,
-}
 
-if ENABLE_AI_AUTOREPLY:
-    required_env.update({
-        "WA_TOKEN": WA_TOKEN,
-        "WA_PHONE_NUMBER_ID": WA_PHONE_NUMBER_ID,
-        "OPENROUTER_API_KEY": OPENROUTER_API_KEY,
-    })
+def telegram_api_base() -> str:
+    config = get_config()
+    return f"{config.get('TELEGRAM_API_URL', DEFAULT_TELEGRAM_API_URL)}/bot{config.get('TELEGRAM_BOT_TOKEN')}"
 
-missing_env = [name for name, value in required_env.items() if not value]
 
-if missing_env:
-    raise RuntimeError(f"Missing required environment variables: {', '.join(missing_env)}")
+def graph_api_base() -> str:
+    return get_config().get("WA_GRAPH_API_URL", DEFAULT_GRAPH_API_URL)
 
-TELEGRAM_API_BASE = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
-WHATSAPP_API_BASE = f"https://graph.facebook.com/v19.0/{WA_PHONE_NUMBER_ID}" if WA_PHONE_NUMBER_ID else None
+
+def whatsapp_api_base() -> Optional[str]:
+    phone_number_id = get_config().get("WA_PHONE_NUMBER_ID")
+    return f"{graph_api_base()}/{phone_number_id}" if phone_number_id else None
 
 
 def build_contact_index(contacts: Iterable[Dict]) -> Dict[str, Dict]:
@@ -102,7 +110,7 @@ def contact_display_name(contact: Dict) -> str:
     return contact.get("profile", {}).get("name", "") if contact else ""
 
 
-def format_message(sender_name: str, message: Dict) -> str:
+def format_message(sender_name: str, message: Dict, media_queued: bool = False) -> str:
     sender_id = message.get("from", "unknown")
     msg_type = message.get("type", "text")
     body = ""
@@ -118,6 +126,11 @@ def format_message(sender_name: str, message: Dict) -> str:
         elif interactive_type == "list_reply":
             reply = interactive.get("list_reply", {})
             body = f"List reply: {reply.get('title')} (id: {reply.get('id')})"
+    elif media_kind(message) and media_queued:
+        caption = media_payload(message).get("caption")
+        body = f"{msg_type} message received; the file is sent as a separate message."
+        if caption:
+            body += f"\n{caption}"
     else:
         body = f"{msg_type} message received (not forwarded in detail)."
 
@@ -140,19 +153,22 @@ def extract_plain_text(message: Dict) -> Optional[str]:
 
 
 def send_to_telegram(text: str) -> bool:
-    if not TELEGRAM_CHAT_ID:
+    chat_id = get_config().get("TELEGRAM_CHAT_ID")
+    if not chat_id:
         logger.warning("TELEGRAM_CHAT_ID is not set; message skipped.")
         return False
 
-    response = requests.post(
-        f"{TELEGRAM_API_BASE}/sendMessage",
-        json={
-            "chat_id": TELEGRAM_CHAT_ID,
-            "text": text,
-            "disable_web_page_preview": True
-        },
-        timeout=10,
-    )
+    with track_call("telegram", "sendMessage") as call:
+        response = requests.post(
+            f"{telegram_api_base()}/sendMessage",
+            json={
+                "chat_id": chat_id,
+                "text": text,
+                "disable_web_page_preview": True
+            },
+            timeout=10,
+        )
+        call.observe(response)
 
     if not response.ok:
         logger.error("Failed to send message to Telegram: %s", response.text)
@@ -161,73 +177,85 @@ def send_to_telegram(text: str) -> bool:
     return True
 
 
-def generate_ai_reply(channel: str, user_id: str, sender_name: str, user_message: str) -> Optional[str]:
-    if not ENABLE_AI_AUTOREPLY or not user_message:
-        return None
-
-    history = storage.get_recent_messages(channel, user_id, limit=30)
-
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": OPENROUTER_REFERRER,
-        "X-Title": OPENROUTER_TITLE,
-    }
-
-    payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [{"role": "system", "content": OPENROUTER_SYSTEM_PROMPT}, *history],
-    }
+def forward_media(sender_name: str, message: Dict) -> bool:
+    config = get_config()
+    kind = media_kind(message)
+    media = media_payload(message)
+    chat_id = config.get("TELEGRAM_CHAT_ID")
+    wa_token = config.get("WA_TOKEN")
+    if not (kind and media.get("id") and chat_id and wa_token and media_forwarding_enabled()):
+        return False
+    if get_storage().load_state(MEDIA_STATE_KIND, media["id"]) is not None:
+        # A webhook retry of media that already reached Telegram.
+        return False
 
-    try:
-        response = requests.post(OPENROUTER_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-    except requests.RequestException as exc:
-        logger.error("OpenRouter request failed: %s", exc)
-        return None
+    sender_id = message.get("from", "unknown")
+    caption = f"WhatsApp {kind} from {sender_name or 'Unknown contact'} ({sender_id})"
+    if media.get("caption"):
+        caption += f":\n{media['caption']}"
+
+    future = media_forwarder.submit(
+        media["id"],
+        kind,
+        caption,
+        graph_api_base=graph_api_base(),
+        telegram_api_base=telegram_api_base(),
+        chat_id=chat_id,
+        wa_token=wa_token,
+        filename=media.get("filename"),
+    )
+    return future is not None
 
-    choices = data.get("choices") or []
-    if not choices:
-        logger.error("OpenRouter returned no choices: %s", data)
-        return None
 
-    message = choices[0].get("message", {})
-    content = message.get("content")
+def generate_ai_reply(
+    channel: str, user_id: str, sender_name: str, user_message: str
+) -> Tuple[Optional[str], Optional[str]]:
+    """Return the reply and the version of the system prompt it was generated with."""
+    if not ai_autoreply_enabled() or not user_message:
+        return None, None
 
-    if isinstance(content, list):
-        # Some models may return a list of parts; concatenate if so.
-        content = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+    config = get_config()
+    prompt = system_prompt()
+    history = get_storage().get_recent_messages(channel, user_id, limit=30)
 
-    if not isinstance(content, str):
-        logger.error("Unexpected OpenRouter content format: %s", content)
-        return None
+    payload = {
+        "model": config.get("OPENROUTER_MODEL", DEFAULT_OPENROUTER_MODEL),
+        "messages": [{"role": "system", "content": prompt.text}, *history],
+    }
 
-    return content.strip()
+    reply = get_llm().complete(
+        payload,
+        caller=WHATSAPP_CHANNEL,
+        title=config.get("OPENROUTER_TITLE", "WhatsAppTelegramBridge"),
+    )
+    return reply, prompt.version
 
 
-def send_whatsapp_reply(recipient_id: str, text: str) -> bool:
-    if not (ENABLE_AI_AUTOREPLY and WHATSAPP_API_BASE and text and recipient_id):
+def send_whatsapp_reply(recipient_id: str, text: str, prompt_version: Optional[str] = None) -> bool:
+    api_base = whatsapp_api_base()
+    if not (ai_autoreply_enabled() and api_base and text and recipient_id):
         return False
 
     try:
-        response = requests.post(
-            f"{WHATSAPP_API_BASE}/messages",
-            headers={
-                "Authorization": f"Bearer {WA_TOKEN}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "messaging_product": "whatsapp",
-                "to": recipient_id,
-                "type": "text",
-                "text": {
-                    "preview_url": False,
-                    "body": text.strip(),
+        with track_call("whatsapp", "messages") as call:
+            response = requests.post(
+                f"{api_base}/messages",
+                headers={
+                    "Authorization": f"Bearer {get_config().get('WA_TOKEN')}",
+                    "Content-Type": "application/json",
                 },
-            },
-            timeout=15,
-        )
+                json={
+                    "messaging_product": "whatsapp",
+                    "to": recipient_id,
+                    "type": "text",
+                    "text": {
+                        "preview_url": False,
+                        "body": text.strip(),
+                    },
+                },
+                timeout=15,
+            )
+            call.observe(response)
     except requests.RequestException as exc:
         logger.error("Failed to send reply to WhatsApp: %s", exc)
         return False
@@ -236,64 +264,190 @@ def send_whatsapp_reply(recipient_id: str, text: str) -> bool:
         logger.error("WhatsApp API error: %s", response.text)
         return False
 
-    storage.add_message(WHATSAPP_CHANNEL, recipient_id, "assistant", text.strip())
+    get_storage().add_message(
+        WHATSAPP_CHANNEL,
+        recipient_id,
+        "assistant",
+        text.strip(),
+        meta={"prompt_version": prompt_version} if prompt_version else None,
+    )
 
     return True
 
 
-@app.route("/webhook", methods=["GET"])
+@webhook.route("/webhook", methods=["GET"])
 def verify_webhook():
     mode = request.args.get("hub.mode")
     token = request.args.get("hub.verify_token")
     challenge = request.args.get("hub.challenge")
 
-    if mode == "subscribe" and token == WA_VERIFY_TOKEN:
+    if mode == "subscribe" and token == get_config().get("WA_VERIFY_TOKEN", "change_me"):
         return challenge, 200
 
     logger.warning("Webhook verification failed: mode=%s token=%s", mode, token)
     return "Verification failed", 403
 
 
-@app.route("/webhook", methods=["POST"])
+def process_message(contact: Dict, message: Dict) -> bool:
+    """Store, forward and answer one WhatsApp message; True if it reached Telegram."""
+    storage = get_storage()
+    sender_name = contact_display_name(contact)
+    sender_id = message.get("from", "unknown")
+    WEBHOOK_MESSAGES.inc(type=message.get("type", "unknown"))
+
+    storage.save_client(
+        WHATSAPP_CHANNEL,
+        sender_id,
+        name=sender_name,
+        phone=sender_id,
+        profile=contact,
+    )
+
+    with span("forward_media"):
+        media_queued = forward_media(sender_name, message)
+    text = format_message(sender_name, message, media_queued)
+    forwarded = send_to_telegram(text)
+
+    customer_text = extract_plain_text(message)
+    stored_text = customer_text or f"[{message.get('type', 'unknown')} message]"
+    storage.add_message(WHATSAPP_CHANNEL, sender_id, "user", stored_text, meta=message)
+
+    with span("ai_reply"):
+        ai_reply, prompt_version = generate_ai_reply(WHATSAPP_CHANNEL, sender_id, sender_name, customer_text or "")
+    if ai_reply:
+        with span("deliver_reply"):
+            if send_whatsapp_reply(sender_id, ai_reply, prompt_version):
+                send_to_telegram(f"🤖 Ответ, отправленный клиенту:\n{ai_reply}")
+    return forwarded
+
+
+@webhook.route("/webhook", methods=["POST"])
+@timed(WEBHOOK_SECONDS, WEBHOOK_ERRORS)
 def handle_whatsapp_webhook():
+    WEBHOOK_BYTES.observe(request.content_length or 0)
     payload = request.get_json()
     if not payload:
         logger.info("Received empty payload.")
         return jsonify({"status": "ignored"}), 200
 
+    forced, base_trace_id = None, None
+    if trace_authorized(request.headers.get(TRACE_TOKEN_HEADER)):
+        forced = parse_trace_header(request.headers.get(TRACE_HEADER))
+        base_trace_id = request.headers.get(TRACE_ID_HEADER)
+    sampled = should_sample(forced)
+    trace_ids = []
     forwarded = 0
-    for contact, message in iter_whatsapp_messages(payload):
-        sender_name = contact_display_name(contact)
-        sender_id = message.get("from", "unknown")
-
-        storage.save_client(
-            WHATSAPP_CHANNEL,
-            sender_id,
-            name=sender_name,
-            phone=sender_id,
-            profile=contact,
-        )
+    for index, (contact, message) in enumerate(iter_whatsapp_messages(payload)):
+        with start_trace(
+            "whatsapp.message",
+            sampled=sampled,
+            trace_id=f"{base_trace_id}-{index}" if base_trace_id else None,
+            message_id=message.get("id"),
+            message_type=message.get("type"),
+        ) as trace:
+            if trace is not None:
+                trace_ids.append(trace.trace_id)
+            if process_message(contact, message):
+                forwarded += 1
+
+    response = jsonify({"forwarded": forwarded})
+    if trace_ids:
+        response.headers[TRACE_ID_HEADER] = ",".join(trace_ids)
+    return response, 200
+
+
+def queue_depths() -> Dict[str, Optional[int]]:
+    depths: Dict[str, Optional[int]] = {"media_forward": media_forwarder.pending}
+    try:
+        llm = get_llm().stats()
+    except (OSError, ValueError) as exc:
+        logger.warning("LLM gateway stats are unavailable: %s", exc)
+        depths.update(llm_active=None, llm_inflight=None)
+    else:
+        depths.update(llm_active=llm["active"], llm_inflight=llm["inflight"])
+    return depths
+
+
+def register_gauges() -> None:
+    REGISTRY.gauge("media_forward_pending", "Media files queued or being forwarded.", lambda: media_forwarder.pending)
+    REGISTRY.gauge("llm_active_requests", "OpenRouter requests on the wire.", lambda: get_llm().stats()["active"])
+    REGISTRY.gauge(
+        "llm_inflight_requests", "Distinct OpenRouter requests waiting or running.", lambda: get_llm().stats()["inflight"]
+    )
 
-        text = format_message(sender_name, message)
-        if send_to_telegram(text):
-            forwarded += 1
 
-        customer_text = extract_plain_text(message)
-        stored_text = customer_text or f"[{message.get('type', 'unknown')} message]"
-        storage.add_message(WHATSAPP_CHANNEL, sender_id, "user", stored_text, meta=message)
+@webhook.get("/healthz")
+def healthcheck():
+    writable = get_storage().is_writable()
+    report = {
+        "status": "ok" if writable else "unavailable",
+        "database": {"writable": writable},
+        "queues": queue_depths(),
+    }
+    return jsonify(report), 200 if writable else 503
 
-        ai_reply = generate_ai_reply(WHATSAPP_CHANNEL, sender_id, sender_name, customer_text or "")
-        if ai_reply and send_whatsapp_reply(sender_id, ai_reply):
-            send_to_telegram(f"🤖 Ответ, отправленный клиенту:\n{ai_reply}")
 
-    return jsonify({"forwarded": forwarded}), 200
+@webhook.get("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
 
 
-@app.get("/healthz")
-def healthcheck():
-    return jsonify({"status": "ok"}), 200
+def _profiler_denied() -> Optional[Tuple[Response, int]]:
+    if not profiler_enabled():
+        return jsonify({"error": "not found"}), 404
+    if not authorized(request.headers.get(PROFILER_TOKEN_HEADER)):
+        return jsonify({"error": "forbidden"}), 403
+    return None
+
+
+@webhook.post("/debug/profile")
+def start_profiling():
+    denied = _profiler_denied()
+    if denied:
+        return denied
+    try:
+        seconds = float(request.args.get("seconds", 10))
+        interval_ms = float(request.args.get("interval_ms", DEFAULT_INTERVAL_MS))
+    except ValueError:
+        return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+    try:
+        started = start_profile(seconds, interval_ms, prefix="app")
+    except ProfilerBusy as exc:
+        return jsonify({"error": "profiler is already running", "profile": str(exc)}), 409
+    return jsonify(started), 202
+
+
+@webhook.get("/debug/profile/<name>")
+def get_profile(name: str):
+    denied = _profiler_denied()
+    if denied:
+        return denied
+    status, folded = load_profile(name)
+    if folded is not None:
+        return Response(folded, content_type="text/plain; charset=utf-8")
+    return jsonify({"status": status}), 202 if status == "running" else 404
+
+
+def create_app() -> Flask:
+    """Build the webhook app: ``gunicorn 'app.main:create_app()'``; nothing runs at import time."""
+    logging.basicConfig(level=logging.INFO)
+    validate_config()
+
+    register_gauges()
+    app = Flask(__name__)
+    app.register_blueprint(webhook)
+    return app
+
+
+def __getattr__(name: str):
+    # Units provisioned before the factory still run ``gunicorn app.main:app``.
+    if name == "app":
+        application = globals()["app"] = create_app()
+        return application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 if __name__ == "__main__":
-    port = int(os.getenv("PORT", 8000))
-    app.run(host="0.0.0.0", port=port)
+    install_reload_signal()
+    application = create_app()
+    application.run(host="0.0.0.0", port=get_config().integer("PORT", 8000))
@@ -0,0 +1,283 @@
+"""Stream WhatsApp media into Telegram uploads without buffering whole files."""
+import contextvars
+import itertools
+import logging
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, Optional, Set, Tuple
+from uuid import uuid4
+
+import requests
+
+from common.config import get_config
+from common.metrics import track_call
+from common.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+MEDIA_STATE_KIND = "whatsapp_media"
+# Meta stops retrying a webhook after 7 days, so older dedupe rows can go.
+DEFAULT_MEDIA_DEDUPE_DAYS = 7
+PRUNE_INTERVAL = 3600
+CHUNK_SIZE = 64 * 1024
+MB = 1024 * 1024
+
+# media kind -> (Bot API method, file field, Bot API upload limit in bytes)
+TELEGRAM_MEDIA_METHODS: Dict[str, Tuple[str, str, int]] = {
+    "image": ("sendPhoto", "photo", 10 * MB),
+    "video": ("sendVideo", "video", 50 * MB),
+    "audio": ("sendAudio", "audio", 50 * MB),
+    "voice": ("sendVoice", "voice", 50 * MB),
+    "document": ("sendDocument", "document", 50 * MB),
+    "sticker": ("sendDocument", "document", 50 * MB),
+}
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+def media_kind(message: Dict) -> Optional[str]:
+    msg_type = message.get("type")
+    if msg_type == "audio" and message.get("audio", {}).get("voice"):
+        return "voice"
+    return msg_type if msg_type in TELEGRAM_MEDIA_METHODS else None
+
+
+def media_payload(message: Dict) -> Dict:
+    return message.get(message.get("type", ""), {}) or {}
+
+
+def _default_filename(media_id: str, content_type: str) -> str:
+    extension = mimetypes.guess_extension(content_type.split(";")[0].strip()) or ""
+    return f"{media_id}{extension}"
+
+
+def multipart_envelope(
+    boundary: str,
+    fields: Dict[str, str],
+    file_field: str,
+    filename: str,
+    content_type: str,
+) -> Tuple[bytes, bytes]:
+    """Return the bytes that go before and after the file in a multipart body."""
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'
+        for name, value in fields.items()
+    ]
+    safe_filename = filename.replace('"', "").replace("\r", "").replace("\n", "")
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; filename="{safe_filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    )
+    return "".join(parts).encode("utf-8"), f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+
+def _limited(chunks: Iterable[bytes], limit: int) -> Iterator[bytes]:
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        if total > limit:
+            raise MediaTooLarge(f"media exceeds {limit} bytes")
+        yield chunk
+
+
+class SizedStream:
+    # requests only sends Content-Length, not chunked encoding, for iterables with a length.
+
+    def __init__(self, chunks: Iterable[bytes], length: int) -> None:
+        self._chunks = chunks
+        self._length = length
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._chunks)
+
+    def __len__(self) -> int:
+        return self._length
+
+
+class MediaForwarder:
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._inflight: Set[str] = set()
+        self._pruned_at: Optional[float] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._inflight)
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._pid != os.getpid():
+            # Threads do not survive fork; start a fresh pool in the worker.
+            self._lock = threading.Lock()
+            self._executor = None
+            self._inflight = set()
+            self._pid = os.getpid()
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers or get_config().integer("MEDIA_FORWARD_CONCURRENCY", 4),
+                    thread_name_prefix="media-forward",
+                )
+            return self._executor
+
+    def submit(self, media_id: str, kind: str, caption: str, **kwargs) -> Optional[Future]:
+        executor = self._get_executor()
+        with self._lock:
+            if media_id in self._inflight:
+                logger.info("Media %s is already being forwarded; skipped.", media_id)
+                return None
+            self._inflight.add(media_id)
+
+        # Run in a copy of the caller's context so the forward joins the message's trace.
+        return executor.submit(contextvars.copy_context().run, self._run, media_id, kind, caption, **kwargs)
+
+    def _run(self, media_id: str, kind: str, caption: str, **kwargs) -> bool:
+        try:
+            return self.forward(media_id, kind, caption, **kwargs)
+        except Exception:  # pragma: no cover - never let a worker thread die silently
+            logger.exception("Unexpected error while forwarding media %s", media_id)
+            return False
+        finally:
+            with self._lock:
+                self._inflight.discard(media_id)
+
+    def forward(
+        self,
+        media_id: str,
+        kind: str,
+        caption: str,
+        *,
+        graph_api_base: str,
+        telegram_api_base: str,
+        chat_id: str,
+        wa_token: str,
+        filename: Optional[str] = None,
+    ) -> bool:
+        storage = get_storage()
+        if storage.load_state(MEDIA_STATE_KIND, media_id):
+            logger.info("Media %s was already forwarded; skipped.", media_id)
+            return True
+
+        method, file_field, limit = TELEGRAM_MEDIA_METHODS[kind]
+        auth = {"Authorization": f"Bearer {wa_token}"}
+
+        try:
+            with track_call("whatsapp", "media") as call:
+                info_response = requests.get(f"{graph_api_base}/{media_id}", headers=auth, timeout=10)
+                call.observe(info_response)
+                info_response.raise_for_status()
+                info = info_response.json()
+        except (requests.RequestException, ValueError) as exc:
+            logger.error("Failed to resolve WhatsApp media %s: %s", media_id, exc)
+            return False
+
+        declared_size = int(info.get("file_size") or 0)
+        if declared_size > limit:
+            return self._report_too_large(telegram_api_base, chat_id, caption, kind, declared_size)
+
+        try:
+            with track_call("whatsapp", "media-download") as call:
+                # Only the response headers are timed here; the body streams into the upload below.
+                download = requests.get(info["url"], headers=auth, stream=True, timeout=(10, 60))
+                call.observe(download, streamed=True)
+            with download:
+                download.raise_for_status()
+                size = int(download.headers.get("Content-Length") or 0)
+                if size > limit:
+                    return self._report_too_large(telegram_api_base, chat_id, caption, kind, size)
+
+                content_type = (
+                    info.get("mime_type")
+                    or download.headers.get("Content-Type")
+                    or "application/octet-stream"
+                )
+                boundary = uuid4().hex
+                head, tail = multipart_envelope(
+                    boundary,
+                    {"chat_id": str(chat_id), "caption": caption[:1024]},
+                    file_field,
+                    filename or _default_filename(media_id, content_type),
+                    content_type,
+                )
+                body: Iterable[bytes] = itertools.chain(
+                    [head],
+                    _limited(download.iter_content(CHUNK_SIZE), limit),
+                    [tail],
+                )
+                if size and not download.headers.get("Content-Encoding"):
+                    body = SizedStream(body, len(head) + size + len(tail))
+
+                with track_call("telegram", method) as upload_call:
+                    upload = requests.post(
+                        f"{telegram_api_base}/{method}",
+                        data=body,
+                        headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+                        timeout=(10, 120),
+                    )
+                    upload_call.observe(upload)
+        except MediaTooLarge:
+            return self._report_too_large(telegram_api_base, chat_id, caption, kind, limit + 1)
+        except (KeyError, requests.RequestException) as exc:
+            logger.error("Failed to stream media %s to Telegram: %s", media_id, exc)
+            return False
+
+        if not upload.ok:
+            logger.error("Telegram %s failed for media %s: %s", method, media_id, upload.text)
+            return False
+
+        storage.save_state(
+            MEDIA_STATE_KIND,
+            media_id,
+            {
+                "method": method,
+                "message_id": upload.json().get("result", {}).get("message_id"),
+                "forwarded_at": datetime.utcnow().isoformat(),
+            },
+        )
+        self._prune_forwarded()
+        return True
+
+    def _prune_forwarded(self) -> None:
+        now = time.monotonic()
+        if self._pruned_at is not None and now - self._pruned_at < PRUNE_INTERVAL:
+            return
+        self._pruned_at = now
+        days = get_config().integer("MEDIA_DEDUPE_DAYS", DEFAULT_MEDIA_DEDUPE_DAYS)
+        cutoff = (datetime.utcnow() - timedelta(days=days)).isoformat()
+        removed = get_storage().prune_states(MEDIA_STATE_KIND, cutoff)
+        if removed:
+            logger.info("Pruned %s forwarded media ids older than %s days.", removed, days)
+
+    def _report_too_large(self, telegram_api_base: str, chat_id: str, caption: str, kind: str, size: int) -> bool:
+        limit_mb = TELEGRAM_MEDIA_METHODS[kind][2] // MB
+        logger.warning(
+            "%s of %s bytes is over the %s MB Telegram limit; sending a notice instead.",
+            kind,
+            size,
+            limit_mb,
+        )
+        text = f"{caption}\n[{kind} is larger than {limit_mb} MB and cannot be forwarded; open it in WhatsApp.]"
+        try:
+            with track_call("telegram", "sendMessage") as call:
+                response = requests.post(
+                    f"{telegram_api_base}/sendMessage",
+                    json={"chat_id": chat_id, "text": text[:4096]},
+                    timeout=10,
+                )
+                call.observe(response)
+        except requests.RequestException as exc:
+            logger.error("Failed to send media size notice to Telegram: %s", exc)
+            return False
+        return response.ok
+
+
+media_forwarder = MediaForwarder()
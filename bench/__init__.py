@@ -0,0 +1 @@
+# Benchmarks and local stand-ins for external APIs
@@ -0,0 +1,445 @@
+"""Benchmark of the Telegram lead bot with simulated users.
+
+The bot from ``bot.telegram_bot.build_application`` runs in this process,
+long-polling a fake Bot API, with OpenRouter replaced by the fake as well.
+Simulated users walk through ``/start`` -> name -> phone -> question -> free
+text, each waiting for the bot to finish an update before sending the next.
+
+Reported per run:
+
+* update -> first reply and update -> fully handled latency, per step;
+* event-loop lag of the bot's loop (overshoot of a 10 ms sleep);
+* time spent in each ``ConversationStorage`` method and waiting for its lock,
+  optionally with a second process writing to the same SQLite file the way
+  the webhook does (``--background-writes``);
+* time spent in ``_persist_log_entry`` and the size of the JSONL log;
+* memory: resident lead state (``lead_states.memory_usage()``), RSS and, with
+  ``--tracemalloc``, Python heap growth over the run.
+
+    python -m bench.bot_load --users 2000 --concurrency 200
+    python -m bench.bot_load --users 500 --background-writes 50 --openrouter-latency-ms 1500
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from bench.fakes import FakeOpenRouter, FakeTelegramAPI, add_fake_arguments, fake_options
+from bench.payloads import FIRST_NAMES, TEXTS
+from bench.report import compare, latency_summary, write_results
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+APPLICATIONS_CHAT_ID = "-1000000000002"
+LOG_CHAT_ID = "-1000000000003"
+FIRST_USER_ID = 500_000_000
+STEPS = ("start", "name", "phone", "question", "free_text")
+STORAGE_METHODS = (
+    "save_client",
+    "add_message",
+    "get_recent_messages",
+    "save_state",
+    "load_state",
+    "delete_state",
+)
+LOOP_LAG_INTERVAL = 0.01
+STEP_TIMEOUT = 120
+
+
+class Samples:
+    """Named lists of durations in seconds, appended from any thread."""
+
+    def __init__(self) -> None:
+        self._values: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self._values.setdefault(name, []).append(seconds)
+
+    @contextmanager
+    def timing(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def timed(self, name: str, function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            with self.timing(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    def summary(self, prefix: str = "") -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            items = [(name, list(values)) for name, values in self._values.items() if name.startswith(prefix)]
+        return {
+            name[len(prefix):]: {**latency_summary(values), "total_ms": round(sum(values) * 1000, 3)}
+            for name, values in sorted(items)
+        }
+
+
+class _TimedLock:
+    """Drop-in for the storage lock that records how long callers waited for it."""
+
+    def __init__(self, samples: Samples) -> None:
+        self._lock = threading.Lock()
+        self._samples = samples
+
+    def __enter__(self) -> bool:
+        started = time.perf_counter()
+        self._lock.acquire()
+        self._samples.add("sqlite.lock_wait", time.perf_counter() - started)
+        return True
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self._lock.release()
+
+
+def instrument(samples: Samples) -> None:
+    """Time the bot's storage calls and log writes in place."""
+    from bot import telegram_bot
+    from common.storage import ConversationStorage, get_storage
+
+    for name in STORAGE_METHODS:
+        setattr(ConversationStorage, name, samples.timed(f"sqlite.{name}", getattr(ConversationStorage, name)))
+    get_storage()._lock = _TimedLock(samples)
+    telegram_bot._persist_log_entry = samples.timed("log.persist_log_entry", telegram_bot._persist_log_entry)
+
+
+def _background_writer(db_path: str, per_second: float, stop: Any, written: Any, locked: Any) -> None:
+    # Runs in a separate process, like a gunicorn worker handling webhooks.
+    from common.storage import ConversationStorage
+
+    storage = ConversationStorage(db_path)
+    interval = 1 / per_second
+    next_at = time.monotonic()
+    while not stop.is_set():
+        try:
+            storage.add_message("whatsapp", f"7700{random.randrange(10_000):07d}", "user", random.choice(TEXTS))
+            written.value += 1
+        except sqlite3.OperationalError:
+            locked.value += 1
+        next_at += interval
+        time.sleep(max(next_at - time.monotonic(), 0))
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as handle:
+            return int(handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def user_script(rng: random.Random) -> List[Tuple[str, str]]:
+    return [
+        ("start", "/start"),
+        ("name", rng.choice(FIRST_NAMES)),
+        ("phone", f"+7700{rng.randrange(10_000_000):07d}"),
+        ("question", rng.choice(TEXTS)),
+        ("free_text", rng.choice(TEXTS)),
+    ]
+
+
+def make_update(user_id: int, text: str) -> Dict[str, Any]:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+    message: Dict[str, Any] = {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"message": message}
+
+
+class _Pending:
+    __slots__ = ("step", "pushed", "first_reply", "handled", "done")
+
+    def __init__(self, step: str, done: asyncio.Future) -> None:
+        self.step = step
+        self.pushed = time.perf_counter()
+        self.first_reply: Optional[float] = None
+        self.handled: Optional[float] = None
+        self.done = done
+
+
+class Simulation:
+    """Simulated users on their own event loop, so they never show up in the bot's loop lag."""
+
+    def __init__(self, telegram: FakeTelegramAPI, args: argparse.Namespace, samples: Samples) -> None:
+        self.telegram = telegram
+        self.args = args
+        self.samples = samples
+        self.loop = asyncio.new_event_loop()
+        self._by_chat: Dict[int, _Pending] = {}
+        self._by_update: Dict[int, _Pending] = {}
+        self.completed_users = 0
+        self.updates_sent = 0
+        self.timeouts = 0
+        telegram.on_message = self.on_message
+
+    def on_message(self, method: str, params: Dict[str, Any]) -> None:
+        # Called from the fake's HTTP threads.
+        try:
+            pending = self._by_chat.get(int(params.get("chat_id")))
+        except (TypeError, ValueError):
+            return
+        if pending is not None and pending.first_reply is None:
+            pending.first_reply = time.perf_counter()
+
+    def on_handled(self, update_id: int) -> None:
+        # Called from the bot's loop once every handler group has run.
+        pending = self._by_update.pop(update_id, None)
+        if pending is not None:
+            pending.handled = time.perf_counter()
+            self.loop.call_soon_threadsafe(lambda: pending.done.done() or pending.done.set_result(None))
+
+    async def _user(self, index: int, slots: asyncio.Semaphore, stop_at: float) -> None:
+        async with slots:
+            user_id = FIRST_USER_ID + index
+            rng = random.Random(index)
+            for step, text in user_script(rng):
+                if time.monotonic() >= stop_at:
+                    return
+                pending = _Pending(step, self.loop.create_future())
+                self._by_chat[user_id] = pending
+                self._by_update[self.telegram.push_update(make_update(user_id, text))] = pending
+                self.updates_sent += 1
+                try:
+                    await asyncio.wait_for(pending.done, STEP_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    return
+                finally:
+                    self._by_chat.pop(user_id, None)
+                if pending.first_reply is not None:
+                    self.samples.add(f"reply.{step}", pending.first_reply - pending.pushed)
+                self.samples.add(f"handled.{step}", pending.handled - pending.pushed)
+                if self.args.think_ms:
+                    await asyncio.sleep(rng.uniform(0, 2 * self.args.think_ms) / 1000)
+            self.completed_users += 1
+
+    async def _run(self) -> None:
+        slots = asyncio.Semaphore(self.args.concurrency)
+        stop_at = time.monotonic() + self.args.duration
+        await asyncio.gather(*(self._user(index, slots, stop_at) for index in range(self.args.users)))
+
+    def run(self) -> None:
+        try:
+            self.loop.run_until_complete(self._run())
+        finally:
+            self.loop.close()
+
+
+async def _watch_loop_lag(samples: Samples) -> None:
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        samples.add("loop.lag", max(time.perf_counter() - started - LOOP_LAG_INTERVAL, 0))
+
+
+async def _watch_memory(timeline: List[Dict[str, Any]], started: float) -> None:
+    from bot.telegram_bot import lead_states
+
+    while True:
+        point: Dict[str, Any] = {"t": round(time.perf_counter() - started, 1), "rss_bytes": _rss_bytes()}
+        point.update({f"lead_state_{key}": value for key, value in lead_states.memory_usage().items()})
+        if tracemalloc.is_tracing():
+            point["python_heap_bytes"] = tracemalloc.get_traced_memory()[0]
+        timeline.append(point)
+        await asyncio.sleep(1)
+
+
+async def run_bot(simulation: Simulation, samples: Samples, timeline: List[Dict[str, Any]]) -> Dict[str, Any]:
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    from bot.telegram_bot import build_application
+
+    application = build_application()
+    errors: List[str] = []
+
+    async def mark_handled(update: Update, context: Any) -> None:
+        simulation.on_handled(update.update_id)
+
+    async def record_error(update: object, context: Any) -> None:
+        errors.append(type(context.error).__name__)
+
+    application.add_handler(TypeHandler(Update, mark_handled), group=1)
+    application.add_error_handler(record_error)
+
+    started = time.perf_counter()
+    watchers = [
+        asyncio.create_task(_watch_loop_lag(samples)),
+        asyncio.create_task(_watch_memory(timeline, started)),
+    ]
+    async with application:
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=5, drop_pending_updates=True)
+        driver = threading.Thread(target=simulation.run, name="simulated-users")
+        driver.start()
+        await asyncio.get_running_loop().run_in_executor(None, driver.join)
+        elapsed = time.perf_counter() - started
+        await application.updater.stop()
+        await application.stop()
+    for task in watchers:
+        task.cancel()
+    return {"elapsed": elapsed, "errors": errors}
+
+
+def bench_env(telegram: FakeTelegramAPI, openrouter: FakeOpenRouter, workdir: str, args: argparse.Namespace) -> Dict[str, str]:
+    return {
+        "TELEGRAM_BOT_TOKEN": "123456:bench-token",
+        "TELEGRAM_API_URL": telegram.url,
+        "TELEGRAM_APPLICATIONS_CHAT_ID": APPLICATIONS_CHAT_ID,
+        "TELEGRAM_NOTIFY_CHAT_ID": "",
+        "TELEGRAM_LOG_CHAT_ID": LOG_CHAT_ID if args.log_chat else "",
+        "OPENROUTER_API_KEY": "bench-key",
+        "OPENROUTER_URL": f"{openrouter.url}/api/v1/chat/completions",
+        "OPENROUTER_SYSTEM_PROMPT_FILE": str(REPO_ROOT / "system_prompt.txt"),
+        "ENABLE_AI_AUTOREPLY": "true" if args.autoreply else "false",
+        "LLM_GATEWAY_SOCKET": "",
+        "LLM_REQUESTS_PER_MINUTE": "0",
+        "CONVERSATIONS_DB_PATH": os.path.join(workdir, "conversations.db"),
+        "CONVERSATION_LOG_DIR": os.path.join(workdir, "conversation_logs"),
+        "BOT_STATE_CACHE_USERS": str(args.state_cache_users),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the Telegram lead bot with simulated users")
+    parser.add_argument("--name", default="bot", help="result name used for baseline comparison")
+    parser.add_argument("--users", type=int, default=2000, help="simulated users in total")
+    parser.add_argument("--concurrency", type=int, default=200, help="users mid-conversation at the same time")
+    parser.add_argument("--duration", type=float, default=120, help="stop starting new steps after this many seconds")
+    parser.add_argument("--think-ms", type=float, default=200, help="mean pause between a user's messages")
+    parser.add_argument("--no-autoreply", dest="autoreply", action="store_false", help="disable the LLM replies")
+    parser.add_argument("--log-chat", action="store_true", help="mirror every message to a log chat")
+    parser.add_argument("--state-cache-users", type=int, default=1000, help="BOT_STATE_CACHE_USERS")
+    parser.add_argument("--background-writes", type=float, default=0, help="webhook-like SQLite inserts per second")
+    parser.add_argument("--tracemalloc", action="store_true", help="track Python heap growth (slows the bot)")
+    parser.add_argument("--output", help="result file (default: bench/results/bot-<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare against")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    telegram = FakeTelegramAPI(**fake_options(args, "telegram"))
+    openrouter = FakeOpenRouter(**fake_options(args, "openrouter"))
+    samples = Samples()
+    timeline: List[Dict[str, Any]] = []
+
+    with tempfile.TemporaryDirectory() as workdir, telegram, openrouter:
+        os.environ.update(bench_env(telegram, openrouter, workdir, args))
+        Path(os.environ["CONVERSATION_LOG_DIR"]).mkdir()
+        instrument(samples)
+
+        writer = None
+        stop_writer = multiprocessing.Event()
+        written = multiprocessing.Value("i", 0)
+        locked = multiprocessing.Value("i", 0)
+        if args.background_writes > 0:
+            writer = multiprocessing.Process(
+                target=_background_writer,
+                args=(os.environ["CONVERSATIONS_DB_PATH"], args.background_writes, stop_writer, written, locked),
+                daemon=True,
+            )
+            writer.start()
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        simulation = Simulation(telegram, args, samples)
+        print(f"==> {args.users} users, {args.concurrency} concurrent", flush=True)
+        try:
+            outcome = asyncio.run(run_bot(simulation, samples, timeline))
+        finally:
+            stop_writer.set()
+            if writer is not None:
+                writer.join(timeout=10)
+        if args.tracemalloc:
+            tracemalloc.stop()
+        log_bytes = sum(path.stat().st_size for path in Path(os.environ["CONVERSATION_LOG_DIR"]).glob("*.jsonl"))
+
+    elapsed = outcome["elapsed"]
+    first, last = (timeline[0], timeline[-1]) if timeline else ({}, {})
+    result = {
+        "name": args.name,
+        "config": {
+            key: getattr(args, key)
+            for key in ("users", "concurrency", "think_ms", "autoreply", "log_chat", "state_cache_users", "background_writes")
+        },
+        "duration_s": round(elapsed, 3),
+        "completed_users": simulation.completed_users,
+        "updates": simulation.updates_sent,
+        "updates_per_s": round(simulation.updates_sent / elapsed, 2) if elapsed else 0.0,
+        "timeouts": simulation.timeouts,
+        "handler_errors": len(outcome["errors"]),
+        "reply_latency_ms": samples.summary("reply."),
+        "handled_latency_ms": samples.summary("handled."),
+        "loop_lag_ms": samples.summary("loop.").get("lag", {}),
+        "sqlite_ms": samples.summary("sqlite."),
+        "log_ms": {**samples.summary("log.").get("persist_log_entry", {}), "file_bytes": log_bytes},
+        "background_writes": {"written": written.value, "locked": locked.value},
+        "memory": {
+            "rss_growth_bytes": (last.get("rss_bytes") or 0) - (first.get("rss_bytes") or 0),
+            "python_heap_growth_bytes": last.get("python_heap_bytes", 0) - first.get("python_heap_bytes", 0),
+            "lead_state_users": last.get("lead_state_users", 0),
+            "lead_state_bytes": last.get("lead_state_bytes", 0),
+            "lead_state_bytes_per_user": last.get("lead_state_bytes_per_user", 0),
+            "timeline": timeline,
+        },
+        "upstream_calls": {"telegram": telegram.stats()["calls"], "openrouter": openrouter.stats()["calls"]},
+    }
+
+    print(
+        f"    {result['updates_per_s']:.1f} updates/s, {result['completed_users']} users done, "
+        f"{result['timeouts']} timeouts, {result['handler_errors']} handler errors",
+        flush=True,
+    )
+    for step in STEPS:
+        latency = result["handled_latency_ms"].get(step)
+        if latency:
+            print(f"    {step:<10} p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, p99 {latency['p99']:.1f} ms")
+    lag = result["loop_lag_ms"]
+    if lag:
+        print(f"    loop lag   p50 {lag['p50']:.1f} ms, p99 {lag['p99']:.1f} ms, max {lag['max']:.1f} ms")
+    lock = result["sqlite_ms"].get("lock_wait")
+    if lock:
+        print(f"    sqlite lock wait p99 {lock['p99']:.2f} ms, total {lock['total_ms']:.0f} ms")
+    log = result["log_ms"]
+    if log.get("count"):
+        print(f"    _persist_log_entry p50 {log['p50']:.3f} ms, total {log['total_ms']:.0f} ms, {log['file_bytes']} bytes")
+    memory = result["memory"]
+    print(
+        f"    lead state {memory['lead_state_users']} users / {memory['lead_state_bytes']} bytes, "
+        f"RSS +{memory['rss_growth_bytes'] // 1024} KiB",
+        flush=True,
+    )
+
+    path = write_results("bot", [result], args.output)
+    print(f"Results saved to {path}")
+    if args.baseline:
+        metrics = ["updates_per_s", "loop_lag_ms.p99", "sqlite_ms.lock_wait.p99", "log_ms.p50"]
+        metrics += [f"handled_latency_ms.{step}.p95" for step in STEPS]
+        for line in compare([result], args.baseline, metrics):
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
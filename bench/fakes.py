@@ -0,0 +1,338 @@
+"""Local stand-ins for the Telegram Bot API, WhatsApp Graph API and OpenRouter.
+
+Each fake is a threaded HTTP server with configurable latency, jitter and
+error rate, so benchmarks can run without network access or API quotas.
+Run them standalone with ``python -m bench.fakes`` to point a manually
+started service at them.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+Response = Tuple[int, Any]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_Server"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _read_body(self) -> bytes:
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b"".join(chunks)
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _dispatch(self) -> None:
+        body = self._read_body()
+        parts = urlsplit(self.path)
+        status, payload = self.server.fake.handle(self.command, parts.path, parse_qs(parts.query), body, self.headers)
+
+        if isinstance(payload, (bytes, bytearray)):
+            data, content_type = bytes(payload), "application/octet-stream"
+        else:
+            data, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = _dispatch
+    do_POST = _dispatch
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address: Tuple[str, int], fake: "FakeServer") -> None:
+        self.fake = fake
+        super().__init__(address, _Handler)
+
+
+class FakeServer:
+    name = "fake"
+
+    def __init__(
+        self,
+        *,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        error_rate: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.calls: Counter = Counter()
+        self.injected_errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), self)
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "FakeServer":
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def handle(self, method: str, path: str, query: Dict, body: bytes, headers) -> Response:
+        with self._lock:
+            self.calls[self.endpoint(method, path)] += 1
+            delay = self.latency_ms + self._random.uniform(0, self.jitter_ms)
+            fail = self._random.random() < self.error_rate
+            if fail:
+                self.injected_errors += 1
+        if delay:
+            time.sleep(delay / 1000)
+        if fail:
+            return self.error_response()
+        return self.respond(method, path, query, body, headers)
+
+    def endpoint(self, method: str, path: str) -> str:
+        return f"{method} {path}"
+
+    def error_response(self) -> Response:
+        return 503, {"error": "injected failure"}
+
+    def respond(self, method: str, path: str, query: Dict, body: bytes, headers) -> Response:
+        return 404, {"error": "not found"}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"calls": dict(self.calls), "injected_errors": self.injected_errors}
+
+
+class FakeTelegramAPI(FakeServer):
+    """Bot API stand-in for both directions.
+
+    Outgoing calls (``sendMessage``, uploads) are answered with plausible
+    results. Incoming traffic for a polling bot is simulated with
+    `push_update`, which ``getUpdates`` long-polls on. ``on_message`` is called
+    as ``on_message(method, params)`` for every ``send*`` call.
+    """
+
+    name = "fake-telegram"
+    bot_user = {"id": 7000000001, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    def __init__(self, *, on_message: Optional[Callable[[str, Dict[str, Any]], None]] = None, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.on_message = on_message
+        self._message_id = 0
+        self.uploaded_bytes = 0
+        self._update_id = 0
+        self._updates: List[Dict[str, Any]] = []
+        self._updates_ready = threading.Condition()
+
+    def endpoint(self, method: str, path: str) -> str:
+        # /bot<token>/<method> -> <method>
+        return path.rsplit("/", 1)[-1]
+
+    def error_response(self) -> Response:
+        return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+
+    def push_update(self, update: Dict[str, Any]) -> int:
+        with self._updates_ready:
+            self._update_id += 1
+            self._updates.append({**update, "update_id": self._update_id})
+            self._updates_ready.notify_all()
+            return self._update_id
+
+    def _get_updates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + min(float(params.get("timeout") or 0), 10)
+        with self._updates_ready:
+            self._updates = [update for update in self._updates if update["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    @staticmethod
+    def _params(body: bytes, headers) -> Dict[str, Any]:
+        content_type = headers.get("Content-Type", "")
+        if "application/json" in content_type:
+            return json.loads(body or b"{}")
+        if "application/x-www-form-urlencoded" in content_type:
+            return {key: values[-1] for key, values in parse_qs(body.decode("utf-8")).items()}
+        return {}
+
+    def respond(self, method: str, path: str, query: Dict, body: bytes, headers) -> Response:
+        api_method = self.endpoint(method, path)
+        params = self._params(body, headers)
+        if api_method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+        if api_method == "getMe":
+            return 200, {"ok": True, "result": self.bot_user}
+        if not api_method.startswith("send"):
+            return 200, {"ok": True, "result": True}
+
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+            if "multipart/form-data" in headers.get("Content-Type", ""):
+                self.uploaded_bytes += len(body)
+        if self.on_message:
+            self.on_message(api_method, params)
+        chat_id = params.get("chat_id") or 0
+        try:
+            chat: Dict[str, Any] = {"id": int(chat_id), "type": "private"}
+        except ValueError:
+            chat = {"id": 0, "type": "channel", "username": str(chat_id).lstrip("@")}
+        return 200, {
+            "ok": True,
+            "result": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": chat,
+                "from": self.bot_user,
+                "text": params.get("text", ""),
+            },
+        }
+
+
+class FakeGraphAPI(FakeServer):
+    name = "fake-graph"
+
+    def __init__(self, *, media_bytes: int = 256 * 1024, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.media_bytes = media_bytes
+        self._blob = bytes(range(256)) * (media_bytes // 256 + 1)
+
+    def endpoint(self, method: str, path: str) -> str:
+        if path.endswith("/messages"):
+            return f"{method} messages"
+        if path.startswith("/media-download/"):
+            return "GET media-download"
+        return f"{method} media"
+
+    def respond(self, method: str, path: str, query: Dict, body: bytes, headers) -> Response:
+        if method == "POST" and path.endswith("/messages"):
+            return 200, {
+                "messaging_product": "whatsapp",
+                "messages": [{"id": f"wamid.fake{random.getrandbits(48):x}"}],
+            }
+        if path.startswith("/media-download/"):
+            return 200, self._blob[: self.media_bytes]
+        media_id = path.rsplit("/", 1)[-1]
+        return 200, {
+            "id": media_id,
+            "url": f"{self.url}/media-download/{media_id}",
+            "mime_type": "image/jpeg",
+            "file_size": self.media_bytes,
+            "messaging_product": "whatsapp",
+        }
+
+
+class FakeOpenRouter(FakeServer):
+    name = "fake-openrouter"
+
+    def __init__(self, *, reply: str = "Спасибо за обращение! Уточните, пожалуйста, детали.", **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.reply = reply
+
+    def endpoint(self, method: str, path: str) -> str:
+        return "chat/completions"
+
+    def error_response(self) -> Response:
+        return 429, {"error": {"code": 429, "message": "Rate limit exceeded: free-models-per-min"}}
+
+    def respond(self, method: str, path: str, query: Dict, body: bytes, headers) -> Response:
+        try:
+            messages = json.loads(body or b"{}").get("messages", [])
+        except ValueError:
+            return 400, {"error": {"message": "invalid JSON"}}
+        prompt_tokens = sum(len(str(message.get("content", ""))) // 4 for message in messages)
+        completion_tokens = len(self.reply) // 4
+        return 200, {
+            "id": f"gen-{random.getrandbits(32):x}",
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": self.reply}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+
+def add_fake_arguments(parser: argparse.ArgumentParser) -> None:
+    for name in ("telegram", "graph", "openrouter"):
+        parser.add_argument(f"--{name}-latency-ms", type=float, default=None)
+        parser.add_argument(f"--{name}-error-rate", type=float, default=None)
+    parser.add_argument("--latency-ms", type=float, default=20, help="default latency of every fake")
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="default error rate of every fake")
+
+
+def fake_options(args: argparse.Namespace, name: str) -> Dict[str, float]:
+    latency = getattr(args, f"{name}_latency_ms")
+    error_rate = getattr(args, f"{name}_error_rate")
+    return {
+        "latency_ms": args.latency_ms if latency is None else latency,
+        "jitter_ms": args.jitter_ms,
+        "error_rate": args.error_rate if error_rate is None else error_rate,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Run the fake upstream APIs until interrupted")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    fakes = [
+        FakeTelegramAPI(**fake_options(args, "telegram")).start(),
+        FakeGraphAPI(**fake_options(args, "graph")).start(),
+        FakeOpenRouter(**fake_options(args, "openrouter")).start(),
+    ]
+    telegram, graph, openrouter = fakes
+    print(f"TELEGRAM_API_URL={telegram.url}")
+    print(f"WA_GRAPH_API_URL={graph.url}")
+    print(f"OPENROUTER_URL={openrouter.url}/api/v1/chat/completions")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for fake in fakes:
+            print(fake.name, json.dumps(fake.stats()))
+            fake.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
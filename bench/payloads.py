@@ -0,0 +1,130 @@
+"""Generator of realistic WhatsApp Cloud API webhook payloads.
+
+The shape follows what Meta actually posts to ``/webhook``: one
+``whatsapp_business_account`` object with ``entry[].changes[].value`` holding
+either ``contacts`` + ``messages`` (inbound traffic) or ``statuses``
+(delivery receipts for our own replies, which make up a large share of real
+webhook volume).
+"""
+import random
+import time
+from typing import Any, Dict, Iterator, List, Optional
+
+PHONE_NUMBER_ID = "893336607192003"
+DISPLAY_PHONE_NUMBER = "77001234567"
+WABA_ID = "102290129340398"
+
+FIRST_NAMES = ["Айгерим", "Ерлан", "Дана", "Тимур", "Алия", "Марат", "Ольга", "Иван", "Asel", "John"]
+TEXTS = [
+    "Здравствуйте! Сколько стоит лендинг?",
+    "Нужен бот для записи клиентов",
+    "Можно созвониться завтра?",
+    "А сроки какие?",
+    "Спасибо, жду ответа",
+    "Хочу автоматизировать заявки из инстаграма, это возможно?",
+    "ок",
+    "Добрый вечер. Подскажите, работаете ли вы с ИП?",
+]
+BUTTONS = [("price", "Узнать цену"), ("call", "Заказать звонок"), ("portfolio", "Портфолио")]
+MIME_TYPES = {
+    "image": "image/jpeg",
+    "document": "application/pdf",
+    "audio": "audio/ogg; codecs=opus",
+    "video": "video/mp4",
+    "sticker": "image/webp",
+}
+STATUSES = ["sent", "delivered", "read"]
+
+
+class PayloadGenerator:
+    def __init__(
+        self,
+        *,
+        seed: Optional[int] = 0,
+        users: int = 1000,
+        status_ratio: float = 0.3,
+        media_ratio: float = 0.05,
+        interactive_ratio: float = 0.1,
+        max_messages: int = 2,
+    ) -> None:
+        self.random = random.Random(seed)
+        self.users = users
+        self.status_ratio = status_ratio
+        self.media_ratio = media_ratio
+        self.interactive_ratio = interactive_ratio
+        self.max_messages = max_messages
+        self._counter = 0
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        while True:
+            yield self.payload()
+
+    def _wamid(self) -> str:
+        self._counter += 1
+        return f"wamid.HBgL{self.random.getrandbits(64):016X}{self._counter:08d}"
+
+    def _wa_id(self) -> str:
+        return f"7700{self.random.randrange(self.users):07d}"
+
+    def message(self, wa_id: str) -> Dict[str, Any]:
+        message: Dict[str, Any] = {
+            "from": wa_id,
+            "id": self._wamid(),
+            "timestamp": str(int(time.time())),
+        }
+        roll = self.random.random()
+        if roll < self.media_ratio:
+            media_type = self.random.choice(list(MIME_TYPES))
+            media: Dict[str, Any] = {
+                "id": str(self.random.getrandbits(52)),
+                "mime_type": MIME_TYPES[media_type],
+                "sha256": f"{self.random.getrandbits(256):064x}",
+            }
+            if media_type == "audio":
+                media["voice"] = True
+            if media_type in {"image", "document", "video"} and self.random.random() < 0.5:
+                media["caption"] = self.random.choice(TEXTS)
+            if media_type == "document":
+                media["filename"] = "ТЗ.pdf"
+            message.update({"type": media_type, media_type: media})
+        elif roll < self.media_ratio + self.interactive_ratio:
+            reply_id, title = self.random.choice(BUTTONS)
+            message.update({
+                "type": "interactive",
+                "interactive": {"type": "button_reply", "button_reply": {"id": reply_id, "title": title}},
+            })
+        else:
+            message.update({"type": "text", "text": {"body": self.random.choice(TEXTS)}})
+        return message
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "id": self._wamid(),
+            "status": self.random.choice(STATUSES),
+            "timestamp": str(int(time.time())),
+            "recipient_id": self._wa_id(),
+            "conversation": {
+                "id": f"{self.random.getrandbits(64):x}",
+                "origin": {"type": "service"},
+            },
+            "pricing": {"billable": True, "pricing_model": "CBP", "category": "service"},
+        }
+
+    def value(self) -> Dict[str, Any]:
+        value: Dict[str, Any] = {
+            "messaging_product": "whatsapp",
+            "metadata": {"display_phone_number": DISPLAY_PHONE_NUMBER, "phone_number_id": PHONE_NUMBER_ID},
+        }
+        if self.random.random() < self.status_ratio:
+            value["statuses"] = [self.status()]
+            return value
+
+        wa_id = self._wa_id()
+        value["contacts"] = [{"profile": {"name": self.random.choice(FIRST_NAMES)}, "wa_id": wa_id}]
+        count = self.random.randint(1, self.max_messages)
+        value["messages"] = [self.message(wa_id) for _ in range(count)]
+        return value
+
+    def payload(self) -> Dict[str, Any]:
+        changes: List[Dict[str, Any]] = [{"field": "messages", "value": self.value()}]
+        return {"object": "whatsapp_business_account", "entry": [{"id": WABA_ID, "changes": changes}]}
@@ -0,0 +1,97 @@
+"""Summaries, result files and baseline comparison shared by the benchmarks."""
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def latency_summary(seconds: List[float]) -> Dict[str, float]:
+    values = sorted(seconds)
+    to_ms = 1000.0
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values) * to_ms, 3) if values else 0.0,
+        "p50": round(percentile(values, 0.50) * to_ms, 3),
+        "p95": round(percentile(values, 0.95) * to_ms, 3),
+        "p99": round(percentile(values, 0.99) * to_ms, 3),
+        "max": round(values[-1] * to_ms, 3) if values else 0.0,
+    }
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(benchmark: str, results: List[Dict[str, Any]], output: Optional[str] = None) -> Path:
+    document = {
+        "benchmark": benchmark,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": _git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": results,
+    }
+    if output:
+        path = Path(output)
+    else:
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        path = RESULTS_DIR / f"{benchmark}-{stamp}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(document, indent=2, ensure_ascii=False), encoding="utf-8")
+    return path
+
+
+def compare(results: List[Dict[str, Any]], baseline_path: str, metrics: Sequence[str]) -> List[str]:
+    """Return one line per configuration comparing ``metrics`` against a saved run.
+
+    Metrics are dotted paths into a result, e.g. ``rps`` or ``latency_ms.p95``.
+    """
+    baseline = json.loads(Path(baseline_path).read_text(encoding="utf-8"))
+    previous = {entry["name"]: entry for entry in baseline.get("results", [])}
+
+    def lookup(entry: Dict[str, Any], dotted: str) -> Optional[float]:
+        value: Any = entry
+        for part in dotted.split("."):
+            if not isinstance(value, dict) or part not in value:
+                return None
+            value = value[part]
+        return value
+
+    lines = []
+    for entry in results:
+        old = previous.get(entry["name"])
+        if not old:
+            lines.append(f"{entry['name']}: no baseline")
+            continue
+        deltas = []
+        for metric in metrics:
+            new_value, old_value = lookup(entry, metric), lookup(old, metric)
+            if new_value is None or not old_value:
+                continue
+            change = (new_value - old_value) / old_value * 100
+            deltas.append(f"{metric} {old_value:g} -> {new_value:g} ({change:+.1f}%)")
+        lines.append(f"{entry['name']}: " + "; ".join(deltas))
+    return lines
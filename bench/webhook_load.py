@@ -0,0 +1,261 @@
+"""Load test for the WhatsApp webhook served by gunicorn.
+
+Starts the fake Telegram, Graph and OpenRouter servers, then for every
+configuration launches ``gunicorn 'app.main:create_app()'`` against a fresh
+SQLite database. It replays generated webhook payloads from a pool of client
+threads for a fixed duration and reports requests per second and
+p50/p95/p99 latency. Results are written as JSON to ``bench/results``.
+
+    python -m bench.webhook_load --duration 20 --concurrency 16
+    python -m bench.webhook_load --config w4:workers=4 --config gthread:workers=2,threads=8 \\
+        --openrouter-latency-ms 800 --error-rate 0.01 --baseline bench/results/webhook-....json
+
+A configuration is ``name:key=value,...`` with keys ``workers``, ``threads``,
+``worker_class``, ``preload`` and ``autoreply``.
+"""
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import requests
+
+from bench.fakes import FakeGraphAPI, FakeOpenRouter, FakeTelegramAPI, add_fake_arguments, fake_options
+from bench.payloads import PHONE_NUMBER_ID, PayloadGenerator
+from bench.report import compare, latency_summary, write_results
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_CONFIGS = [
+    "sync-w1:workers=1",
+    "sync-w4:workers=4",
+    "gthread-w2t8:workers=2,threads=8",
+]
+FALSY_VALUES = {"0", "false", "no"}
+
+
+def parse_config(spec: str) -> Dict[str, Any]:
+    name, _, options = spec.partition(":")
+    config: Dict[str, Any] = {
+        "name": name,
+        "workers": 1,
+        "threads": 1,
+        "worker_class": None,
+        "preload": True,
+        "autoreply": True,
+    }
+    for option in filter(None, options.split(",")):
+        key, _, value = option.partition("=")
+        if key in {"workers", "threads"}:
+            config[key] = int(value)
+        elif key in {"preload", "autoreply"}:
+            config[key] = value.lower() not in FALSY_VALUES
+        elif key == "worker_class":
+            config[key] = value
+        else:
+            raise SystemExit(f"Unknown option {key!r} in configuration {spec!r}")
+    if config["worker_class"] is None:
+        config["worker_class"] = "gthread" if config["threads"] > 1 else "sync"
+    return config
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_healthy(url: str, process: subprocess.Popen, timeout: float = 20) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with code {process.returncode}")
+        try:
+            if requests.get(f"{url}/healthz", timeout=1).ok:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError("gunicorn did not become healthy in time")
+
+
+def service_env(fakes: Dict[str, Any], workdir: str, autoreply: bool) -> Dict[str, str]:
+    return {
+        **os.environ,
+        "PYTHONUNBUFFERED": "1",
+        "TELEGRAM_BOT_TOKEN": "bench-token",
+        "TELEGRAM_CHAT_ID": "-1000000000001",
+        "WA_TOKEN": "bench-token",
+        "WA_PHONE_NUMBER_ID": PHONE_NUMBER_ID,
+        "OPENROUTER_API_KEY": "bench-key",
+        "TELEGRAM_API_URL": fakes["telegram"].url,
+        "WA_GRAPH_API_URL": fakes["graph"].url,
+        "OPENROUTER_URL": f"{fakes['openrouter'].url}/api/v1/chat/completions",
+        "OPENROUTER_SYSTEM_PROMPT_FILE": str(REPO_ROOT / "system_prompt.txt"),
+        "CONVERSATIONS_DB_PATH": os.path.join(workdir, "conversations.db"),
+        "ENABLE_AI_AUTOREPLY": "true" if autoreply else "false",
+        "LLM_GATEWAY_SOCKET": "",
+        "LLM_REQUESTS_PER_MINUTE": "0",
+    }
+
+
+def _client(url: str, seed: int, stop_at: float, generator_options: Dict[str, Any], out: List) -> None:
+    generator = PayloadGenerator(seed=seed, **generator_options)
+    session = requests.Session()
+    latencies: List[float] = []
+    errors = 0
+    while time.monotonic() < stop_at:
+        payload = generator.payload()
+        started = time.perf_counter()
+        try:
+            response = session.post(f"{url}/webhook", json=payload, timeout=60)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        latencies.append(time.perf_counter() - started)
+        if not ok:
+            errors += 1
+    out.append((latencies, errors))
+
+
+def run_load(
+    url: str,
+    concurrency: int,
+    duration: float,
+    generator_options: Dict[str, Any],
+    seed_base: int = 0,
+) -> Dict[str, Any]:
+    results: List = []
+    stop_at = time.monotonic() + duration
+    threads = [
+        threading.Thread(target=_client, args=(url, seed, stop_at, generator_options, results))
+        for seed in range(seed_base, seed_base + concurrency)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    latencies = [value for chunk, _ in results for value in chunk]
+    errors = sum(count for _, count in results)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(elapsed, 3),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": latency_summary(latencies),
+    }
+
+
+def run_config(config: Dict[str, Any], fakes: Dict[str, Any], args: argparse.Namespace) -> Dict[str, Any]:
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}"
+    command = [
+        sys.executable, "-m", "gunicorn",
+        "--bind", f"127.0.0.1:{port}",
+        "--workers", str(config["workers"]),
+        "--threads", str(config["threads"]),
+        "--worker-class", config["worker_class"],
+        "--log-level", "warning",
+        "--timeout", "120",
+    ]
+    if config["preload"]:
+        command.append("--preload")
+    command.append("app.main:create_app()")
+
+    generator_options = {
+        "users": args.users,
+        "status_ratio": args.status_ratio,
+        "media_ratio": args.media_ratio,
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        process = subprocess.Popen(
+            command,
+            cwd=REPO_ROOT,
+            env=service_env(fakes, workdir, config["autoreply"]),
+        )
+        try:
+            _wait_until_healthy(url, process)
+            if args.warmup:
+                run_load(url, args.concurrency, args.warmup, generator_options, seed_base=10_000)
+            before = {name: fake.stats()["calls"] for name, fake in fakes.items()}
+            result = run_load(url, args.concurrency, args.duration, generator_options)
+            after = {name: fake.stats()["calls"] for name, fake in fakes.items()}
+        finally:
+            process.send_signal(signal.SIGTERM)
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    upstream = {
+        name: {key: count - before[name].get(key, 0) for key, count in calls.items() if count - before[name].get(key, 0)}
+        for name, calls in after.items()
+    }
+    return {
+        "name": config["name"],
+        "config": {key: value for key, value in config.items() if key != "name"},
+        "concurrency": args.concurrency,
+        **result,
+        "upstream_calls": upstream,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Load test the WhatsApp webhook under gunicorn")
+    parser.add_argument("--config", action="append", dest="configs", help="name:key=value,... (repeatable)")
+    parser.add_argument("--duration", type=float, default=15, help="seconds of measured load per configuration")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds of unmeasured load first")
+    parser.add_argument("--concurrency", type=int, default=16, help="number of client threads")
+    parser.add_argument("--users", type=int, default=1000, help="distinct WhatsApp senders")
+    parser.add_argument("--status-ratio", type=float, default=0.3, help="share of status-only payloads")
+    parser.add_argument("--media-ratio", type=float, default=0.05, help="share of media messages")
+    parser.add_argument("--media-bytes", type=int, default=256 * 1024, help="size of each fake media file")
+    parser.add_argument("--output", help="result file (default: bench/results/webhook-<timestamp>.json)")
+    parser.add_argument("--baseline", help="earlier result file to compare against")
+    add_fake_arguments(parser)
+    args = parser.parse_args()
+
+    configs = [parse_config(spec) for spec in (args.configs or DEFAULT_CONFIGS)]
+    fakes = {
+        "telegram": FakeTelegramAPI(**fake_options(args, "telegram")),
+        "graph": FakeGraphAPI(media_bytes=args.media_bytes, **fake_options(args, "graph")),
+        "openrouter": FakeOpenRouter(**fake_options(args, "openrouter")),
+    }
+    for fake in fakes.values():
+        fake.start()
+
+    results = []
+    try:
+        for config in configs:
+            print(f"==> {config['name']}: {config}", flush=True)
+            result = run_config(config, fakes, args)
+            latency = result["latency_ms"]
+            print(
+                f"    {result['rps']:.1f} req/s, errors {result['errors']}, "
+                f"p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, p99 {latency['p99']:.1f} ms",
+                flush=True,
+            )
+            results.append(result)
+    finally:
+        for fake in fakes.values():
+            fake.stop()
+
+    path = write_results("webhook", results, args.output)
+    print(f"Results saved to {path}")
+    if args.baseline:
+        for line in compare(results, args.baseline, ["rps", "latency_ms.p50", "latency_ms.p95", "latency_ms.p99"]):
+            print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
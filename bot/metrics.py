@@ -0,0 +1,57 @@
+from typing import Any, Dict, Optional, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import HTTPXRequest, RequestData
+
+from common.metrics import REGISTRY, track_call
+from common.storage import get_storage
+from common.tracing import start_trace
+
+
+class TracedApplication(Application):
+    """Runs every Telegram update inside its own trace (see `common.tracing`)."""
+
+    async def process_update(self, update: object) -> None:
+        if not isinstance(update, Update):
+            await super().process_update(update)
+            return
+        user = update.effective_user
+        with start_trace("telegram.update", update_id=update.update_id, user_id=user.id if user else None):
+            await super().process_update(update)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPX transport for PTB that records every Bot API call in `common.metrics`."""
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: Optional[RequestData] = None,
+        **kwargs: Any,
+    ) -> Tuple[int, bytes]:
+        with track_call("telegram", url.rsplit("/", 1)[-1]) as call:
+            code, payload = await super().do_request(url, method, request_data=request_data, **kwargs)
+            sent = len(request_data.json_payload) if request_data and not request_data.multipart_data else None
+            call.record(status=code, sent=sent, received=len(payload))
+        return code, payload
+
+
+def register_gauges(application: Application, lead_states: Any) -> None:
+    REGISTRY.gauge("bot_update_queue_size", "Updates fetched but not yet handled.", application.update_queue.qsize)
+    REGISTRY.gauge("bot_lead_state_users", "Lead forms resident in memory.", lambda: lead_states.users)
+    REGISTRY.gauge(
+        "bot_lead_state_bytes",
+        "Approximate size of resident lead forms at the last cache sweep.",
+        lambda: lead_states.last_usage["bytes"],
+    )
+
+
+def health(application: Application) -> Tuple[bool, Dict[str, Any]]:
+    writable = get_storage().is_writable()
+    return writable, {
+        "status": "ok" if writable else "unavailable",
+        "database": {"writable": writable},
+        "queues": {"updates": application.update_queue.qsize()},
+    }
@@ -0,0 +1,174 @@
+import json
+import logging
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple, Union
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from common.storage import get_storage
+
+logger = logging.getLogger(__name__)
+
+LEAD_STATE_KIND = "telegram_lead"
+CONVERSATION_STATE_KIND = "telegram_conversation"
+
+ConversationKey = Tuple[Union[int, str], ...]
+ConversationDict = Dict[ConversationKey, object]
+
+
+def _deep_sizeof(value: Any) -> int:
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(_deep_sizeof(key) + _deep_sizeof(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(_deep_sizeof(item) for item in value)
+    return size
+
+
+class LeadStateStore:
+    """Per-user lead form, written through to SQLite with an LRU cache of active users."""
+
+    def __init__(self, max_users: int = 1000, idle_seconds: float = 3600, sweep_interval: float = 600) -> None:
+        self.max_users = max_users
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self.last_usage = {"users": 0, "bytes": 0, "bytes_per_user": 0}
+        self._cache: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    @property
+    def users(self) -> int:
+        return len(self._cache)
+
+    def get(self, user_id: int) -> Dict[str, Any]:
+        cached = self._cache.pop(user_id, None)
+        if cached is None:
+            data = get_storage().load_state(LEAD_STATE_KIND, str(user_id)) or {}
+        else:
+            data = cached[1]
+        now = time.monotonic()
+        self._cache[user_id] = (now, data)
+        if len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+        if now >= self._next_sweep:
+            self.sweep(now)
+        return data
+
+    def update(self, user_id: int, **fields: Any) -> Dict[str, Any]:
+        data = self.get(user_id)
+        data.update(fields)
+        get_storage().save_state(LEAD_STATE_KIND, str(user_id), data)
+        return data
+
+    def reset(self, user_id: int) -> None:
+        self._cache[user_id] = (time.monotonic(), {})
+        self._cache.move_to_end(user_id)
+        if len(self._cache) > self.max_users:
+            self._cache.popitem(last=False)
+        get_storage().delete_state(LEAD_STATE_KIND, str(user_id))
+
+    def evict_idle(self) -> int:
+        cutoff = time.monotonic() - self.idle_seconds
+        evicted = 0
+        while self._cache:
+            user_id, (last_seen, _) = next(iter(self._cache.items()))
+            if last_seen >= cutoff:
+                break
+            del self._cache[user_id]
+            evicted += 1
+        return evicted
+
+    def sweep(self, now: Optional[float] = None) -> None:
+        """Evict idle users and refresh `last_usage`; runs from `get` every ``sweep_interval`` seconds."""
+        self._next_sweep = (now or time.monotonic()) + self.sweep_interval
+        evicted = self.evict_idle()
+        self.last_usage = self.memory_usage()
+        logger.info(
+            "Lead state cache: evicted %s idle users, %s resident, %s bytes (%s bytes/user)",
+            evicted,
+            self.last_usage["users"],
+            self.last_usage["bytes"],
+            self.last_usage["bytes_per_user"],
+        )
+
+    def memory_usage(self) -> Dict[str, int]:
+        users = len(self._cache)
+        total = sum(_deep_sizeof(data) for _, data in self._cache.values())
+        return {
+            "users": users,
+            "bytes": total,
+            "bytes_per_user": total // users if users else 0,
+        }
+
+
+class StoragePersistence(BasePersistence):
+    """Persists ConversationHandler states only; per-user data lives in `LeadStateStore`."""
+
+    def __init__(self, update_interval: float = 10) -> None:
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+
+    @staticmethod
+    def _state_key(name: str, key: ConversationKey) -> str:
+        return json.dumps([name, *key])
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        conversations: ConversationDict = {}
+        for raw_key, state in get_storage().load_states(CONVERSATION_STATE_KIND).items():
+            stored_name, *key = json.loads(raw_key)
+            if stored_name == name:
+                conversations[tuple(key)] = state
+        return conversations
+
+    async def update_conversation(self, name: str, key: ConversationKey, new_state: Optional[object]) -> None:
+        storage_key = self._state_key(name, key)
+        if new_state is None:
+            get_storage().delete_state(CONVERSATION_STATE_KIND, storage_key)
+        else:
+            get_storage().save_state(CONVERSATION_STATE_KIND, storage_key, new_state)
+
+    async def get_user_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict[Any, Any]]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[Any, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def update_user_data(self, user_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_chat_data(self, chat_id: int, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_bot_data(self, data: Dict[Any, Any]) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Dict[Any, Any]) -> None:
+        pass
+
+    async def flush(self) -> None:
+        pass
@@ -1,15 +1,13 @@
 import asyncio
+import contextvars
 import json
 import logging
-import os
 from datetime import date, datetime, timedelta, time as dtime, timezone
 from functools import partial
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from uuid import uuid4
 
-import requests
-from dotenv import load_dotenv
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -25,83 +23,56 @@ try:
 except ImportError:  # pragma: no cover
     ZoneInfo = None
 
-from common.storage import storage
+from bot.metrics import InstrumentedRequest, TracedApplication, health, register_gauges
+from bot.persistence import LeadStateStore, StoragePersistence
+from common.config import Config, SystemPrompt, get_config, install_reload_signal
+from common.llm import get_llm, llm_configured
+from common.metrics import serve_metrics
+from common.tracing import span
+from common.storage import get_storage
 
-load_dotenv()
-
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 STATE_NAME, STATE_PHONE, STATE_QUESTION = range(3)
 TELEGRAM_CHANNEL = "telegram"
+TRANSCRIPT_WINDOW = 50
 
-TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-TELEGRAM_NOTIFY_CHAT_ID = os.getenv("TELEGRAM_NOTIFY_CHAT_ID")
-TELEGRAM_LOG_CHAT_ID = os.getenv("TELEGRAM_LOG_CHAT_ID")
-TELEGRAM_APPLICATIONS_CHAT_ID = os.getenv("TELEGRAM_APPLICATIONS_CHAT_ID") or TELEGRAM_NOTIFY_CHAT_ID
-TELEGRAM_ANALYTICS_CHAT_ID = os.getenv("TELEGRAM_ANALYTICS_CHAT_ID")
-CONVERSATION_LOG_DIR = Path(os.getenv("CONVERSATION_LOG_DIR", "conversation_logs"))
-CONVERSATION_LOG_DIR.mkdir(parents=True, exist_ok=True)
-DAILY_ANALYTICS_HOUR = int(os.getenv("DAILY_ANALYTICS_HOUR", "23"))
-DAILY_ANALYTICS_MINUTE = int(os.getenv("DAILY_ANALYTICS_MINUTE", "30"))
-DAILY_ANALYTICS_TZ_NAME = os.getenv("DAILY_ANALYTICS_TZ", "UTC")
-ENABLE_DAILY_ANALYTICS = os.getenv("ENABLE_DAILY_ANALYTICS", "true").lower() not in {"0", "false", "no"}
-
-OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
-OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "z-ai/glm-4.5-air:free")
-OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
-OPENROUTER_SYSTEM_PROMPT_FILE = os.getenv("OPENROUTER_SYSTEM_PROMPT_FILE", "system_prompt.txt")
-OPENROUTER_REFERRER = os.getenv("OPENROUTER_REFERRER", "https://example.com")
-OPENROUTER_TITLE = os.getenv("OPENROUTER_TITLE", "TelegramLeadBot")
-ENABLE_AI_AUTOREPLY = os.getenv("ENABLE_AI_AUTOREPLY", "true").lower() not in {"0", "false", "no"}
-
-if not TELEGRAM_BOT_TOKEN:
-    raise RuntimeError("TELEGRAM_BOT_TOKEN is required")
-
+lead_states = LeadStateStore()
 
+DEFAULT_TELEGRAM_API_URL = "https://api.telegram.org"
+DEFAULT_OPENROUTER_MODEL = "z-ai/glm-4.5-air:free"
 DEFAULT_SYSTEM_PROMPT = (
     "Ты дружелюбный ассистент отдела продаж. Собираешь контакты, отвечаешь по делу, "
     "если нужно — предлагаешь консультацию менеджера."
 )
 
 
-def _load_system_prompt() -> str:
-    prompt_env = os.getenv("OPENROUTER_SYSTEM_PROMPT")
-    if prompt_env:
-        return prompt_env.strip()
-
-    path = Path(OPENROUTER_SYSTEM_PROMPT_FILE)
-    try:
-        text = path.read_text(encoding="utf-8").strip()
-        if text:
-            return text
-        logger.warning("System prompt file %s is empty; using default.", path)
-    except FileNotFoundError:
-        logger.warning("System prompt file %s not found; falling back to default.", path)
-    except OSError as exc:
-        logger.warning("Failed to read system prompt file %s: %s", path, exc)
-
-    return DEFAULT_SYSTEM_PROMPT
-
-
-OPENROUTER_SYSTEM_PROMPT = _load_system_prompt()
+def system_prompt() -> SystemPrompt:
+    return get_config().system_prompt(DEFAULT_SYSTEM_PROMPT)
 
 
 def _get_analytics_tz():
+    tz_name = get_config().get("DAILY_ANALYTICS_TZ", "UTC")
     if ZoneInfo:
         try:
-            return ZoneInfo(DAILY_ANALYTICS_TZ_NAME)
+            return ZoneInfo(tz_name)
         except Exception:  # pragma: no cover
-            logger.warning("Unknown timezone %s, falling back to UTC", DAILY_ANALYTICS_TZ_NAME)
+            logger.warning("Unknown timezone %s, falling back to UTC", tz_name)
     return timezone.utc
 
 
-ANALYTICS_TZ = _get_analytics_tz()
+def _conversation_log_dir() -> Path:
+    return Path(get_config().get("CONVERSATION_LOG_DIR", "conversation_logs"))
+
+
+def _applications_chat_id() -> Optional[str]:
+    config = get_config()
+    return config.get("TELEGRAM_APPLICATIONS_CHAT_ID") or config.get("TELEGRAM_NOTIFY_CHAT_ID")
 
 
 def _log_file_path(target_date: Optional[date] = None) -> Path:
-    target_date = target_date or datetime.now(tz=ANALYTICS_TZ).date()
-    return CONVERSATION_LOG_DIR / f"{target_date.isoformat()}.jsonl"
+    target_date = target_date or datetime.now(tz=_get_analytics_tz()).date()
+    return _conversation_log_dir() / f"{target_date.isoformat()}.jsonl"
 
 
 def _persist_log_entry(record: Dict) -> None:
@@ -116,15 +87,15 @@ async def _log_conversation_message(
     role: str,
     text: str,
     send_to_log_chat: bool = True,
+    *,
+    prompt_version: Optional[str] = None,
 ) -> None:
     if not text:
         return
 
     timestamp = datetime.utcnow().isoformat()
-    conversation_id = context.user_data.setdefault(
-        "conversation_id",
-        f"{user.id}-{uuid4().hex[:8]}",
-    )
+    state = lead_states.get(user.id)
+    conversation_id = state.get("conversation_id") or f"{user.id}-{uuid4().hex[:8]}"
     entry = {
         "conversation_id": conversation_id,
         "user_id": user.id,
@@ -134,94 +105,86 @@ async def _log_conversation_message(
         "text": text,
         "timestamp": timestamp,
     }
-    transcript = context.user_data.setdefault("transcript", [])
-    transcript.append({"role": role, "text": text, "timestamp": timestamp})
-    _persist_log_entry(entry)
+    with span("persist_log_entry"):
+        _persist_log_entry(entry)
 
     storage_role = "assistant" if role == "bot" else role
+    storage = get_storage()
     storage.save_client(
         TELEGRAM_CHANNEL,
         str(user.id),
         name=user.full_name,
         profile={"username": user.username},
     )
-    storage.add_message(TELEGRAM_CHANNEL, str(user.id), storage_role, text)
+    meta = {"prompt_version": prompt_version} if prompt_version else None
+    message_id = storage.add_message(TELEGRAM_CHANNEL, str(user.id), storage_role, text, meta=meta)
+    if "conversation_id" not in state:
+        lead_states.update(user.id, conversation_id=conversation_id, transcript_start=message_id)
 
-    if TELEGRAM_LOG_CHAT_ID and send_to_log_chat:
+    log_chat_id = get_config().get("TELEGRAM_LOG_CHAT_ID")
+    if log_chat_id and send_to_log_chat:
         preview = f"[{timestamp}] {user.full_name} ({user.id})\n{role}: {text}"
         await context.bot.send_message(
-            chat_id=TELEGRAM_LOG_CHAT_ID,
+            chat_id=log_chat_id,
             text=preview[:4096],
             disable_notification=True,
         )
 
 
-def _format_transcript(context: ContextTypes.DEFAULT_TYPE) -> str:
-    transcript = context.user_data.get("transcript") or []
+def _format_transcript(user_id: int) -> str:
+    start_id = lead_states.get(user_id).get("transcript_start")
+    if start_id is None:
+        return "—"
+    transcript = get_storage().get_recent_messages(
+        TELEGRAM_CHANNEL,
+        str(user_id),
+        limit=TRANSCRIPT_WINDOW,
+        since_id=start_id,
+    )
     if not transcript:
         return "—"
-    lines = [f"{item['role']}: {item['text']}" for item in transcript]
+    lines = [
+        f"{'bot' if item['role'] == 'assistant' else item['role']}: {item['content']}"
+        for item in transcript
+    ]
     combined = "\n".join(lines)
     return combined[-4000:] if len(combined) > 4000 else combined
 
 
-def _call_openrouter(payload: Dict) -> Optional[str]:
-    if not (ENABLE_AI_AUTOREPLY and OPENROUTER_API_KEY):
-        return None
-
-    headers = {
-        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": OPENROUTER_REFERRER,
-        "X-Title": OPENROUTER_TITLE,
-    }
-
-    try:
-        response = requests.post(OPENROUTER_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()
-        data = response.json()
-    except requests.RequestException as exc:
-        logger.error("OpenRouter API error: %s", exc)
-        return None
-
-    choices = data.get("choices") or []
-    if not choices:
-        logger.error("OpenRouter returned empty choices: %s", data)
+def _call_llm(payload: Dict, caller: str) -> Optional[str]:
+    config = get_config()
+    if not (config.flag("ENABLE_AI_AUTOREPLY") and llm_configured()):
         return None
 
-    message = choices[0].get("message", {})
-    content = message.get("content")
-
-    if isinstance(content, list):
-        content = "".join(
-            part.get("text", "") if isinstance(part, dict) else str(part)
-            for part in content
-        )
-
-    if not isinstance(content, str):
-        logger.error("Unexpected OpenRouter response: %s", content)
-        return None
-
-    return content.strip()
+    return get_llm().complete(
+        payload,
+        caller=caller,
+        title=config.get("OPENROUTER_TITLE", "TelegramLeadBot"),
+    )
 
 
-async def generate_ai_reply(user_id: str, user_text: str) -> Optional[str]:
+async def generate_ai_reply(user_id: str, user_text: str) -> Tuple[Optional[str], Optional[str]]:
+    """Return the reply and the version of the system prompt it was generated with."""
     if not user_text:
-        return None
+        return None, None
 
-    history = storage.get_recent_messages(TELEGRAM_CHANNEL, user_id, limit=30)
+    prompt = system_prompt()
+    history = get_storage().get_recent_messages(TELEGRAM_CHANNEL, user_id, limit=30)
     payload = {
-        "model": OPENROUTER_MODEL,
-        "messages": [{"role": "system", "content": OPENROUTER_SYSTEM_PROMPT}, *history],
+        "model": get_config().get("OPENROUTER_MODEL", DEFAULT_OPENROUTER_MODEL),
+        "messages": [{"role": "system", "content": prompt.text}, *history],
     }
 
     loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, partial(_call_openrouter, payload))
+    with span("ai_reply"):
+        reply = await loop.run_in_executor(
+            None, partial(contextvars.copy_context().run, _call_llm, payload, TELEGRAM_CHANNEL)
+        )
+    return reply, prompt.version
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data.clear()
-    context.user_data["transcript"] = []
+    lead_states.reset(update.effective_user.id)
     if update.message:
         await _log_conversation_message(update.effective_user, context, "user", update.message.text)
     greeting = "Привет! Я помогу передать вашу заявку менеджеру.\nКак вас зовут?"
@@ -231,12 +194,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 
 async def capture_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["name"] = update.message.text.strip()
+    name = update.message.text.strip()
+    lead_states.update(update.effective_user.id, name=name)
     await _log_conversation_message(update.effective_user, context, "user", update.message.text)
-    storage.save_client(
+    get_storage().save_client(
         TELEGRAM_CHANNEL,
         str(update.effective_user.id),
-        name=context.user_data["name"],
+        name=name,
         profile={"username": update.effective_user.username},
     )
     prompt = "Отлично. Оставьте, пожалуйста, номер телефона для связи."
@@ -258,11 +222,11 @@ async def capture_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         )
         return STATE_PHONE
 
-    context.user_data["phone"] = phone
-    storage.save_client(
+    state = lead_states.update(update.effective_user.id, phone=phone)
+    get_storage().save_client(
         TELEGRAM_CHANNEL,
         str(update.effective_user.id),
-        name=context.user_data.get("name"),
+        name=state.get("name"),
         phone=phone,
         profile={"username": update.effective_user.username},
     )
@@ -273,7 +237,8 @@ async def capture_phone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
 
 async def capture_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data["question"] = update.message.text.strip()
+    question = update.message.text.strip()
+    lead_states.update(update.effective_user.id, question=question)
     await _log_conversation_message(update.effective_user, context, "user", update.message.text)
 
     awaiting_text = (
@@ -284,16 +249,16 @@ async def capture_question(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await _log_conversation_message(update.effective_user, context, "bot", awaiting_text)
 
     await send_application(update, context)
-    reply = await generate_ai_reply(str(update.effective_user.id), context.user_data["question"])
+    reply, prompt_version = await generate_ai_reply(str(update.effective_user.id), question)
     if reply:
         await update.message.reply_text(reply)
-        await _log_conversation_message(update.effective_user, context, "bot", reply)
+        await _log_conversation_message(update.effective_user, context, "bot", reply, prompt_version=prompt_version)
 
     return ConversationHandler.END
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data.clear()
+    lead_states.reset(update.effective_user.id)
     if update.message:
         await _log_conversation_message(update.effective_user, context, "user", update.message.text)
     cancel_text = "Хорошо, заявку отменяем. Если передумаете — напишите /start."
@@ -305,11 +270,11 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def handle_free_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     text = update.message.text.strip()
     await _log_conversation_message(update.effective_user, context, "user", text)
-    reply = await generate_ai_reply(str(update.effective_user.id), text)
+    reply, prompt_version = await generate_ai_reply(str(update.effective_user.id), text)
 
     if reply:
         await update.message.reply_text(reply)
-        await _log_conversation_message(update.effective_user, context, "bot", reply)
+        await _log_conversation_message(update.effective_user, context, "bot", reply, prompt_version=prompt_version)
     else:
         fallback = "Спасибо! Передам ваш вопрос менеджеру. Напишите /start, если нужна новая заявка."
         await update.message.reply_text(fallback)
@@ -317,14 +282,14 @@ async def handle_free_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 
 async def send_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    target_chat = TELEGRAM_APPLICATIONS_CHAT_ID or TELEGRAM_NOTIFY_CHAT_ID
+    target_chat = _applications_chat_id()
     if not target_chat:
         logger.warning("TELEGRAM_APPLICATIONS_CHAT_ID не задан, заявка не отправлена.")
         return
 
     user = update.effective_user
-    data = context.user_data
-    transcript_text = _format_transcript(context)
+    data = lead_states.get(user.id)
+    transcript_text = _format_transcript(user.id)
 
     summary = (
         "Заявка для ИП Aian Back 📋\n"
@@ -339,11 +304,16 @@ async def send_application(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 
 async def _send_daily_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
-    target_chat = TELEGRAM_ANALYTICS_CHAT_ID or TELEGRAM_LOG_CHAT_ID or TELEGRAM_APPLICATIONS_CHAT_ID
-    if not (target_chat and ENABLE_DAILY_ANALYTICS and OPENROUTER_API_KEY):
+    config = get_config()
+    target_chat = (
+        config.get("TELEGRAM_ANALYTICS_CHAT_ID")
+        or config.get("TELEGRAM_LOG_CHAT_ID")
+        or _applications_chat_id()
+    )
+    if not (target_chat and config.flag("ENABLE_DAILY_ANALYTICS") and llm_configured()):
         return
 
-    report_date = datetime.now(tz=ANALYTICS_TZ).date() - timedelta(days=1)
+    report_date = datetime.now(tz=_get_analytics_tz()).date() - timedelta(days=1)
     log_path = _log_file_path(report_date)
     if not log_path.exists():
         logger.info("Нет логов за %s, отчёт пропущен", report_date)
@@ -358,7 +328,7 @@ async def _send_daily_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
     )
 
     payload = {
-        "model": OPENROUTER_MODEL,
+        "model": config.get("OPENROUTER_MODEL", DEFAULT_OPENROUTER_MODEL),
         "messages": [
             {"role": "system", "content": "Ты аналитик отдела продаж. Пиши кратко, по пунктам."},
             {"role": "user", "content": prompt},
@@ -366,7 +336,7 @@ async def _send_daily_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
     }
 
     loop = asyncio.get_running_loop()
-    summary = await loop.run_in_executor(None, partial(_call_openrouter, payload))
+    summary = await loop.run_in_executor(None, partial(_call_llm, payload, "telegram-analytics"))
     summary_text = summary or "Не удалось получить ответ от модели."
 
     await context.bot.send_message(
@@ -382,8 +352,24 @@ async def _send_daily_analytics(context: ContextTypes.DEFAULT_TYPE) -> None:
         )
 
 
-def main() -> None:
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+def build_application(config: Optional[Config] = None) -> Application:
+    """Wire the handlers and jobs; ``main`` runs the result with long polling."""
+    config = config or get_config()
+    lead_states.max_users = config.integer("BOT_STATE_CACHE_USERS", 1000)
+    lead_states.idle_seconds = config.integer("BOT_STATE_IDLE_SECONDS", 3600)
+
+    api_url = config.get("TELEGRAM_API_URL", DEFAULT_TELEGRAM_API_URL)
+    application = (
+        Application.builder()
+        .application_class(TracedApplication)
+        .token(config.get("TELEGRAM_BOT_TOKEN"))
+        .base_url(f"{api_url}/bot")
+        .base_file_url(f"{api_url}/file/bot")
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+        .persistence(StoragePersistence(update_interval=config.integer("BOT_PERSISTENCE_INTERVAL", 10)))
+        .build()
+    )
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -393,15 +379,38 @@ def main() -> None:
             STATE_QUESTION: [MessageHandler(filters.TEXT & ~filters.COMMAND, capture_question)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="lead_form",
+        persistent=True,
     )
 
     application.add_handler(conv_handler)
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_free_text))
+    register_gauges(application, lead_states)
 
     if application.job_queue:
-        daily_time = dtime(hour=DAILY_ANALYTICS_HOUR, minute=DAILY_ANALYTICS_MINUTE, tzinfo=ANALYTICS_TZ)
+        daily_time = dtime(
+            hour=config.integer("DAILY_ANALYTICS_HOUR", 23),
+            minute=config.integer("DAILY_ANALYTICS_MINUTE", 30),
+            tzinfo=_get_analytics_tz(),
+        )
         application.job_queue.run_daily(_send_daily_analytics, time=daily_time)
 
+    return application
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    config = get_config()
+    config.require("TELEGRAM_BOT_TOKEN")
+    install_reload_signal(config)
+    if config.flag("ENABLE_AI_AUTOREPLY") and not llm_configured():
+        logger.warning("OPENROUTER_API_KEY is not set; AI replies and daily analytics are disabled.")
+    _conversation_log_dir().mkdir(parents=True, exist_ok=True)
+
+    application = build_application(config)
+    metrics_port = config.integer("BOT_METRICS_PORT", 0)
+    if metrics_port:
+        serve_metrics(metrics_port, partial(health, application), profile_prefix="bot")
     application.run_polling(drop_pending_updates=True)
 
 
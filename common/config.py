@@ -0,0 +1,210 @@
+import hashlib
+import logging
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, NamedTuple, Optional, Set, Tuple
+
+from dotenv import dotenv_values, find_dotenv
+
+logger = logging.getLogger(__name__)
+
+FALSY_VALUES = {"0", "false", "no"}
+DEFAULT_PROMPT_FILE = "system_prompt.txt"
+DEFAULT_RELOAD_INTERVAL = 2.0
+
+
+class SystemPrompt(NamedTuple):
+    text: str
+    version: str
+
+
+def prompt_version(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:12]
+
+
+class Config:
+    """Lazily loaded `.env` settings, re-read when `.env` or the prompt file changes."""
+
+    def __init__(self, env_file: Optional[str] = None) -> None:
+        self.env_file = env_file
+        self.check_interval = DEFAULT_RELOAD_INTERVAL
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._env_path = ""
+        self._process_env: Set[str] = set()
+        self._dotenv_keys: Set[str] = set()
+        self._cache: Dict[Tuple[str, str, Any], Any] = {}
+        self._prompts: Dict[str, SystemPrompt] = {}
+        self._mtimes: Tuple[Optional[float], ...] = ()
+        self._checked_at = 0.0
+        self._reload_requested = False
+
+    def load(self) -> None:
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            self._process_env = set(os.environ)
+            self._env_path = self.env_file or find_dotenv()
+            self._apply_dotenv()
+            self.check_interval = float(os.getenv("CONFIG_RELOAD_INTERVAL", DEFAULT_RELOAD_INTERVAL))
+            self._mtimes = self._watched_mtimes()
+            self._checked_at = time.monotonic()
+            self._loaded = True
+
+    def reload(self) -> None:
+        self.load()
+        with self._lock:
+            self._apply_dotenv()
+            self._cache.clear()
+            self._prompts.clear()
+            self._mtimes = self._watched_mtimes()
+            self._checked_at = time.monotonic()
+            self._reload_requested = False
+        logger.info("Configuration reloaded from %s", self._env_path or "process environment")
+
+    def request_reload(self) -> None:
+        # Safe to call from a signal handler: the actual work happens on the next lookup.
+        self._reload_requested = True
+
+    def get(self, name: str, default: Optional[str] = None) -> Optional[str]:
+        return self._cached("str", name, default, lambda: os.getenv(name, default))
+
+    def flag(self, name: str, default: bool = True) -> bool:
+        def parse() -> bool:
+            value = os.getenv(name)
+            if value is None:
+                return default
+            return value.lower() not in FALSY_VALUES
+
+        return self._cached("flag", name, default, parse)
+
+    def integer(self, name: str, default: int) -> int:
+        def parse() -> int:
+            value = os.getenv(name)
+            return int(value) if value else default
+
+        return self._cached("int", name, default, parse)
+
+    def number(self, name: str, default: float) -> float:
+        def parse() -> float:
+            value = os.getenv(name)
+            return float(value) if value else default
+
+        return self._cached("float", name, default, parse)
+
+    def require(self, *names: str) -> None:
+        missing = [name for name in names if not self.get(name)]
+        if missing:
+            raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+    def system_prompt(self, default: str) -> SystemPrompt:
+        """`OPENROUTER_SYSTEM_PROMPT`, else the prompt file, else ``default``, with its version hash."""
+        self._check_for_changes()
+        prompt = self._prompts.get(default)
+        if prompt is not None:
+            return prompt
+        with self._lock:
+            prompt = self._prompts.get(default)
+            if prompt is None:
+                text = self._read_prompt(default)
+                prompt = self._prompts[default] = SystemPrompt(text, prompt_version(text))
+                logger.info("Loaded system prompt version %s", prompt.version)
+        return prompt
+
+    def _cached(self, kind: str, name: str, default: Any, parse) -> Any:
+        self._check_for_changes()
+        key = (kind, name, default)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        # Parse and store under the lock reload() holds, so a value read before a reload
+        # can never land in the cache it just cleared.
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = parse()
+            return self._cache[key]
+
+    def _check_for_changes(self) -> None:
+        self.load()
+        if self._reload_requested:
+            self.reload()
+            return
+        if self.check_interval <= 0:
+            return
+
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if self._watched_mtimes() != self._mtimes:
+            self.reload()
+
+    def _apply_dotenv(self) -> None:
+        values = dotenv_values(self._env_path) if self._env_path else {}
+        for name in self._dotenv_keys - set(values):
+            os.environ.pop(name, None)
+
+        applied = set()
+        for name, value in values.items():
+            if name in self._process_env or value is None:
+                continue
+            os.environ[name] = value
+            applied.add(name)
+        self._dotenv_keys = applied
+
+    def _prompt_path(self) -> Path:
+        return Path(os.getenv("OPENROUTER_SYSTEM_PROMPT_FILE", DEFAULT_PROMPT_FILE))
+
+    def _watched_mtimes(self) -> Tuple[Optional[float], ...]:
+        mtimes = []
+        for path in (self._env_path, self._prompt_path()):
+            try:
+                mtimes.append(os.stat(path).st_mtime if path else None)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _read_prompt(self, default: str) -> str:
+        prompt_env = os.getenv("OPENROUTER_SYSTEM_PROMPT")
+        if prompt_env:
+            return prompt_env.strip()
+
+        path = self._prompt_path()
+        try:
+            text = path.read_text(encoding="utf-8").strip()
+            if text:
+                return text
+            logger.warning("System prompt file %s is empty; falling back to default.", path)
+        except FileNotFoundError:
+            logger.warning("System prompt file %s not found; using default prompt.", path)
+        except OSError as exc:
+            logger.warning("Failed to read system prompt file %s: %s", path, exc)
+
+        return default
+
+
+_config: Optional[Config] = None
+_config_lock = threading.Lock()
+
+
+def get_config() -> Config:
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = Config()
+    return _config
+
+
+def install_reload_signal(config: Optional[Config] = None) -> None:
+    """Reload configuration on SIGHUP. Must be called from the main thread."""
+    if not hasattr(signal, "SIGHUP"):
+        return
+    target = config or get_config()
+    signal.signal(signal.SIGHUP, lambda signum, frame: target.request_reload())
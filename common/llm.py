@@ -0,0 +1,353 @@
+"""Shared OpenRouter gateway for the webhook and the lead bot (``python -m common.llm serve``)."""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.config import get_config
+from common.metrics import LLM_TOKENS, OUTBOUND_ERRORS, track_call
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+SOCKET_TIMEOUT = 90
+UPSTREAM_TIMEOUT = 30
+# Webhook requests wait in the queue on a gunicorn worker; keep this well under its --timeout.
+DEFAULT_QUEUE_TIMEOUT = 5
+
+
+def extract_content(data: Dict[str, Any]) -> Optional[str]:
+    choices = data.get("choices") or []
+    if not choices:
+        logger.error("OpenRouter returned no choices: %s", data)
+        return None
+
+    message = choices[0].get("message", {})
+    content = message.get("content")
+
+    if isinstance(content, list):
+        # Some models may return a list of parts; concatenate if so.
+        content = "".join(part.get("text", "") if isinstance(part, dict) else str(part) for part in content)
+
+    if not isinstance(content, str):
+        logger.error("Unexpected OpenRouter content format: %s", content)
+        return None
+
+    return content.strip()
+
+
+class RateLimiter:
+    """Sliding one-minute window shared by every caller of the gateway."""
+
+    def __init__(self, per_minute: int) -> None:
+        self.per_minute = per_minute
+        self._lock = threading.Lock()
+        self._sent: Deque[float] = deque()
+
+    def acquire(self, timeout: float) -> bool:
+        if self.per_minute <= 0:
+            return True
+
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                while self._sent and now - self._sent[0] >= 60:
+                    self._sent.popleft()
+                if len(self._sent) < self.per_minute:
+                    self._sent.append(now)
+                    return True
+                wait = 60 - (now - self._sent[0])
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(wait, remaining))
+
+
+class _InflightCall:
+    __slots__ = ("event", "result")
+
+    def __init__(self) -> None:
+        self.event = threading.Event()
+        self.result: Optional[str] = None
+
+
+class LLMGateway:
+    def __init__(
+        self,
+        *,
+        requests_per_minute: Optional[int] = None,
+        max_concurrency: Optional[int] = None,
+        queue_timeout: Optional[float] = None,
+    ) -> None:
+        config = get_config()
+        self.max_concurrency = max_concurrency or config.integer("LLM_MAX_CONCURRENCY", 4)
+        self.queue_timeout = queue_timeout if queue_timeout is not None else config.integer("LLM_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT)
+        self.rate_limiter = RateLimiter(
+            requests_per_minute if requests_per_minute is not None else config.integer("LLM_REQUESTS_PER_MINUTE", 20)
+        )
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, _InflightCall] = {}
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._active = 0
+
+    def complete(self, payload: Dict[str, Any], *, caller: str, title: Optional[str] = None) -> Optional[str]:
+        key = hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        with self._lock:
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _InflightCall()
+
+        if not leader:
+            call.event.wait()
+            self._record(caller, merged=1)
+            return call.result
+
+        try:
+            call.result = self._execute(payload, caller=caller, title=title)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            call.event.set()
+        return call.result
+
+    def _execute(self, payload: Dict[str, Any], *, caller: str, title: Optional[str]) -> Optional[str]:
+        config = get_config()
+        api_key = config.get("OPENROUTER_API_KEY")
+        if not api_key:
+            logger.error("OPENROUTER_API_KEY is not set; %s request skipped.", caller)
+            self._record(caller, errors=1)
+            OUTBOUND_ERRORS.inc(service="openrouter", operation="chat/completions", kind="not_configured")
+            return None
+
+        started = time.monotonic()
+        if not self.rate_limiter.acquire(self.queue_timeout):
+            logger.warning("LLM rate limit reached; %s request dropped.", caller)
+            self._record(caller, rate_limited=1)
+            OUTBOUND_ERRORS.inc(service="openrouter", operation="chat/completions", kind="rate_limited")
+            return None
+
+        remaining = max(self.queue_timeout - (time.monotonic() - started), 0)
+        if not self._slots.acquire(timeout=remaining):
+            logger.warning("LLM concurrency budget exhausted; %s request dropped.", caller)
+            self._record(caller, rate_limited=1)
+            OUTBOUND_ERRORS.inc(service="openrouter", operation="chat/completions", kind="queue_timeout")
+            return None
+
+        headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+            "HTTP-Referer": config.get("OPENROUTER_REFERRER", "https://example.com"),
+            "X-Title": title or config.get("OPENROUTER_TITLE", "WhatsAppTelegramBridge"),
+        }
+
+        with self._lock:
+            self._active += 1
+        sent = time.monotonic()
+        try:
+            with track_call("openrouter", "chat/completions") as call:
+                response = self._session.post(
+                    config.get("OPENROUTER_URL", DEFAULT_OPENROUTER_URL),
+                    headers=headers,
+                    json=payload,
+                    timeout=UPSTREAM_TIMEOUT,
+                )
+                call.observe(response)
+                response.raise_for_status()
+                data = response.json()
+        except (requests.RequestException, ValueError) as exc:
+            logger.error("OpenRouter request failed for %s: %s", caller, exc)
+            self._record(caller, requests=1, errors=1, latency=time.monotonic() - sent)
+            return None
+        finally:
+            with self._lock:
+                self._active -= 1
+            self._slots.release()
+
+        usage = data.get("usage") or {}
+        LLM_TOKENS.inc(usage.get("prompt_tokens") or 0, caller=caller, kind="prompt")
+        LLM_TOKENS.inc(usage.get("completion_tokens") or 0, caller=caller, kind="completion")
+        self._record(
+            caller,
+            requests=1,
+            latency=time.monotonic() - sent,
+            queued=sent - started,
+            prompt_tokens=usage.get("prompt_tokens") or 0,
+            completion_tokens=usage.get("completion_tokens") or 0,
+        )
+        content = extract_content(data)
+        if content is None:
+            self._record(caller, errors=1)
+        return content
+
+    def _record(self, caller: str, *, latency: Optional[float] = None, queued: float = 0, **counters: float) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(
+                caller,
+                {
+                    "requests": 0,
+                    "merged": 0,
+                    "errors": 0,
+                    "rate_limited": 0,
+                    "prompt_tokens": 0,
+                    "completion_tokens": 0,
+                    "latency_seconds_total": 0.0,
+                    "latency_seconds_max": 0.0,
+                    "queued_seconds_total": 0.0,
+                },
+            )
+            for name, value in counters.items():
+                stats[name] += value
+            if latency is not None:
+                stats["latency_seconds_total"] += latency
+                stats["latency_seconds_max"] = max(stats["latency_seconds_max"], latency)
+            stats["queued_seconds_total"] += queued
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            callers = {caller: dict(values) for caller, values in self._stats.items()}
+            active = self._active
+            inflight = len(self._inflight)
+        for values in callers.values():
+            values["latency_seconds_avg"] = (
+                values["latency_seconds_total"] / values["requests"] if values["requests"] else 0.0
+            )
+        return {"active": active, "inflight": inflight, "callers": callers}
+
+
+class _GatewayRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        line = self.rfile.readline()
+        try:
+            request = json.loads(line)
+            op = request.get("op")
+            if op == "complete":
+                content = self.server.gateway.complete(
+                    request["payload"],
+                    caller=request.get("caller", "unknown"),
+                    title=request.get("title"),
+                )
+                reply: Dict[str, Any] = {"content": content}
+            elif op == "stats":
+                reply = self.server.gateway.stats()
+            else:
+                reply = {"error": f"unknown op {op!r}"}
+        except (ValueError, KeyError, TypeError) as exc:
+            reply = {"error": str(exc)}
+        self.wfile.write(json.dumps(reply, ensure_ascii=False).encode("utf-8") + b"\n")
+
+
+class GatewayServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, gateway: LLMGateway) -> None:
+        self.gateway = gateway
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, _GatewayRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+
+class GatewayClient:
+    """Talks to a `GatewayServer`; same `complete()` signature as `LLMGateway`."""
+
+    def __init__(self, socket_path: str) -> None:
+        self.socket_path = socket_path
+
+    def _request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(SOCKET_TIMEOUT)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(request, ensure_ascii=False).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as reader:
+                return json.loads(reader.readline())
+
+    def complete(self, payload: Dict[str, Any], *, caller: str, title: Optional[str] = None) -> Optional[str]:
+        try:
+            with track_call("llm_gateway", "complete"):
+                reply = self._request({"op": "complete", "payload": payload, "caller": caller, "title": title})
+        except (OSError, ValueError) as exc:
+            logger.error("LLM gateway at %s is unavailable: %s", self.socket_path, exc)
+            return None
+        if "error" in reply:
+            logger.error("LLM gateway error: %s", reply["error"])
+            return None
+        return reply.get("content")
+
+    def stats(self) -> Dict[str, Any]:
+        return self._request({"op": "stats"})
+
+
+_llm: Any = None
+_llm_pid: Optional[int] = None
+_llm_lock = threading.Lock()
+
+
+def llm_configured() -> bool:
+    """True if requests can reach OpenRouter: through the shared gateway or with a local API key."""
+    config = get_config()
+    return bool(config.get("LLM_GATEWAY_SOCKET") or config.get("OPENROUTER_API_KEY"))
+
+
+def get_llm():
+    """The shared gateway server if ``LLM_GATEWAY_SOCKET`` is set, else a per-process `LLMGateway`."""
+    global _llm, _llm_pid
+    if _llm is None or _llm_pid != os.getpid():
+        with _llm_lock:
+            if _llm is None or _llm_pid != os.getpid():
+                socket_path = get_config().get("LLM_GATEWAY_SOCKET")
+                _llm = GatewayClient(socket_path) if socket_path else LLMGateway()
+                _llm_pid = os.getpid()
+    return _llm
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Shared OpenRouter gateway")
+    parser.add_argument("command", choices=["serve", "stats"])
+    parser.add_argument("--socket", default=None, help="Unix socket path (default: LLM_GATEWAY_SOCKET)")
+    args = parser.parse_args()
+
+    socket_path = args.socket or get_config().get("LLM_GATEWAY_SOCKET", os.path.join("data", "llm-gateway.sock"))
+
+    if args.command == "stats":
+        print(json.dumps(GatewayClient(socket_path).stats(), indent=2))
+        return 0
+
+    logging.basicConfig(level=logging.INFO)
+    directory = os.path.dirname(socket_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    gateway = LLMGateway()
+    with GatewayServer(socket_path, gateway) as server:
+        logger.info(
+            "LLM gateway listening on %s (%s rpm, %s concurrent)",
+            socket_path,
+            gateway.rate_limiter.per_minute,
+            gateway.max_concurrency,
+        )
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
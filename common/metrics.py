@@ -0,0 +1,368 @@
+"""In-process Prometheus counters, histograms and gauges, plus instrumentation helpers."""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from common.profiler import TOKEN_HEADER, ProfilerBusy, authorized, load_profile, profiler_enabled, start_profile
+from common.tracing import Span, span
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 52428800)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, Any]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.kind}\n"
+        return header + "".join(f"{line}\n" for line in self.samples())
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in values]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: bucket counts (non-cumulative, last one is +Inf), sum.
+        self._values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            entry[0][index] += 1
+            entry[1][0] += value
+
+    @contextmanager
+    def time(self, **labels: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge(_Metric):
+    """Value read from a callback at scrape time, e.g. a queue depth."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Optional[float]]) -> None:
+        super().__init__(name, documentation)
+        self.callback = callback
+
+    def samples(self) -> List[str]:
+        try:
+            value = self.callback()
+        except Exception as exc:
+            logger.warning("Gauge %s is unavailable: %s", self.name, exc)
+            return []
+        return [] if value is None else [f"{self.name} {_format_value(value)}"]
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        # Re-registering a name replaces it, so gauges can be rebound to a new app or bot.
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], Optional[float]]) -> Gauge:
+        return self.register(Gauge(name, documentation, callback))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() for metric in metrics)
+
+
+REGISTRY = Registry()
+
+STORAGE_SECONDS = REGISTRY.histogram(
+    "storage_operation_seconds", "Time spent in ConversationStorage methods.", ["operation"]
+)
+STORAGE_ERRORS = REGISTRY.counter(
+    "storage_errors_total", "ConversationStorage calls that raised, by exception.", ["operation", "kind"]
+)
+OUTBOUND_SECONDS = REGISTRY.histogram(
+    "outbound_request_seconds", "Latency of calls to external APIs.", ["service", "operation"]
+)
+OUTBOUND_BYTES = REGISTRY.histogram(
+    "outbound_payload_bytes", "Request and response body sizes of external API calls.",
+    ["service", "direction"], buckets=SIZE_BUCKETS,
+)
+OUTBOUND_ERRORS = REGISTRY.counter(
+    "outbound_errors_total", "Failed external API calls by kind (HTTP status or exception).",
+    ["service", "operation", "kind"],
+)
+LLM_TOKENS = REGISTRY.counter("llm_tokens_total", "Tokens reported by OpenRouter.", ["caller", "kind"])
+WEBHOOK_SECONDS = REGISTRY.histogram("webhook_request_seconds", "Time to handle one WhatsApp webhook POST.")
+WEBHOOK_BYTES = REGISTRY.histogram(
+    "webhook_payload_bytes", "Size of WhatsApp webhook bodies.", buckets=SIZE_BUCKETS
+)
+WEBHOOK_ERRORS = REGISTRY.counter("webhook_errors_total", "Webhook requests that raised, by exception.", ["kind"])
+WEBHOOK_MESSAGES = REGISTRY.counter("webhook_messages_total", "WhatsApp messages received, by type.", ["type"])
+
+
+def timed(histogram: Histogram, errors: Optional[Counter] = None, **labels: Any) -> Callable:
+    """Decorator recording the duration of every call, and its exception type on failure."""
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception as exc:
+                if errors is not None:
+                    errors.inc(**labels, kind=type(exc).__name__)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+
+        return wrapper
+
+    return decorator
+
+
+class Call:
+    """Handle yielded by `track_call`; tell it what came back."""
+
+    __slots__ = ("service", "operation", "failed", "span")
+
+    def __init__(self, service: str, operation: str, span: Optional[Span] = None) -> None:
+        self.service = service
+        self.operation = operation
+        self.failed = False
+        self.span = span
+
+    def record(self, *, status: Optional[int] = None, sent: Optional[int] = None, received: Optional[int] = None) -> None:
+        if sent is not None:
+            OUTBOUND_BYTES.observe(sent, service=self.service, direction="sent")
+        if received is not None:
+            OUTBOUND_BYTES.observe(received, service=self.service, direction="received")
+        if self.span is not None:
+            self.span.set(status=status, sent_bytes=sent, received_bytes=received)
+        if status is not None and status >= 400:
+            self.error(f"http_{status}")
+
+    def observe(self, response: Any, *, streamed: bool = False) -> None:
+        """Record a ``requests.Response``; a streamed body is sized from its headers, not read."""
+        body = response.request.body if response.request is not None else None
+        sent = len(body) if body is not None and hasattr(body, "__len__") else None
+        if streamed:
+            received = int(response.headers.get("Content-Length") or 0) or None
+        else:
+            received = len(response.content)
+        self.record(status=response.status_code, sent=sent, received=received)
+
+    def error(self, kind: str) -> None:
+        self.failed = True
+        OUTBOUND_ERRORS.inc(service=self.service, operation=self.operation, kind=kind)
+
+
+@contextmanager
+def track_call(service: str, operation: str) -> Iterator[Call]:
+    started = time.perf_counter()
+    with span(f"{service}.{operation}") as current:
+        call = Call(service, operation, current)
+        try:
+            yield call
+        except Exception as exc:
+            if not call.failed:  # an HTTP status already recorded is the more useful kind
+                call.error(type(exc).__name__)
+            raise
+        finally:
+            OUTBOUND_SECONDS.observe(time.perf_counter() - started, service=service, operation=operation)
+
+
+HealthCheck = Callable[[], Tuple[bool, Dict[str, Any]]]
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    server: "_MetricsServer"
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+    def _send(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: Dict[str, Any]) -> None:
+        self._send(status, "application/json", json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+    def do_GET(self) -> None:
+        path = urlsplit(self.path).path
+        if path == "/metrics":
+            self._send(200, CONTENT_TYPE, REGISTRY.render().encode("utf-8"))
+        elif path == "/healthz":
+            ready, report = self.server.health()
+            self._send_json(200 if ready else 503, report)
+        elif path.startswith("/debug/profile/"):
+            if not self._profiler_allowed():
+                return
+            status, folded = load_profile(path.rsplit("/", 1)[-1])
+            if folded is not None:
+                self._send(200, "text/plain; charset=utf-8", folded.encode("utf-8"))
+            else:
+                self._send_json(202 if status == "running" else 404, {"status": status})
+        else:
+            self._send_json(404, {"error": "not found"})
+
+    def do_POST(self) -> None:
+        parts = urlsplit(self.path)
+        if parts.path != "/debug/profile":
+            self._send_json(404, {"error": "not found"})
+            return
+        if not self._profiler_allowed():
+            return
+        query = parse_qs(parts.query)
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+            interval_ms = float(query.get("interval_ms", ["5"])[0])
+        except ValueError:
+            self._send_json(400, {"error": "seconds and interval_ms must be numbers"})
+            return
+        try:
+            self._send_json(202, start_profile(seconds, interval_ms, prefix=self.server.profile_prefix))
+        except ProfilerBusy as exc:
+            self._send_json(409, {"error": "profiler is already running", "profile": str(exc)})
+
+    def _profiler_allowed(self) -> bool:
+        if not profiler_enabled():
+            self._send_json(404, {"error": "not found"})
+            return False
+        if not authorized(self.headers.get(TOKEN_HEADER)):
+            self._send_json(403, {"error": "forbidden"})
+            return False
+        return True
+
+
+class _MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], health: HealthCheck, profile_prefix: str) -> None:
+        self.health = health
+        self.profile_prefix = profile_prefix
+        super().__init__(address, _MetricsHandler)
+
+
+def serve_metrics(
+    port: int,
+    health: HealthCheck,
+    host: str = "127.0.0.1",
+    profile_prefix: str = "profile",
+) -> ThreadingHTTPServer:
+    """Serve ``/metrics``, ``/healthz`` and the opt-in ``/debug/profile`` endpoints from a daemon thread."""
+    server = _MetricsServer((host, port), health, profile_prefix)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Metrics available on http://%s:%s/metrics", host, server.server_address[1])
+    return server
@@ -0,0 +1,110 @@
+"""Opt-in sampling profiler that writes folded stacks to ``PROFILE_DIR``."""
+import hmac
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from common.config import get_config
+
+DEFAULT_PROFILE_DIR = os.path.join("data", "profiles")
+TOKEN_HEADER = "X-Profiler-Token"
+DEFAULT_INTERVAL_MS = 5
+_NAME_PATTERN = re.compile(r"^[\w.-]+$")
+
+_running_lock = threading.Lock()
+_running: Optional[str] = None
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def profile_dir() -> Path:
+    return Path(get_config().get("PROFILE_DIR", DEFAULT_PROFILE_DIR))
+
+
+def profiler_enabled() -> bool:
+    return bool(get_config().get("PROFILER_TOKEN"))
+
+
+def authorized(token: Optional[str]) -> bool:
+    expected = get_config().get("PROFILER_TOKEN")
+    return bool(expected and token and hmac.compare_digest(expected.encode(), token.encode()))
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """Folded stacks of every other thread, counted over ``seconds``."""
+    own = threading.get_ident()
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            labels.append(names.get(ident, f"thread-{ident}"))
+            stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def _run(name: str, seconds: float, interval: float, directory: Path) -> None:
+    global _running
+    try:
+        stacks = sample_stacks(seconds, interval)
+        partial = directory / f"{name}.folded.tmp"
+        with partial.open("w", encoding="utf-8") as handle:
+            for stack, count in stacks.most_common():
+                handle.write(f"{stack} {count}\n")
+        partial.replace(directory / f"{name}.folded")
+    finally:
+        (directory / f"{name}.running").unlink(missing_ok=True)
+        with _running_lock:
+            _running = None
+
+
+def start_profile(seconds: float, interval_ms: float = DEFAULT_INTERVAL_MS, *, prefix: str = "profile") -> Dict[str, object]:
+    """Start sampling this process in the background; raises `ProfilerBusy` if already sampling."""
+    global _running
+    config = get_config()
+    seconds = min(max(seconds, 0.1), config.integer("PROFILER_MAX_SECONDS", 60))
+    interval = max(interval_ms, 1) / 1000
+    directory = profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+
+    with _running_lock:
+        if _running is not None:
+            raise ProfilerBusy(_running)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        name = _running = f"{prefix}-{os.getpid()}-{stamp}"
+    (directory / f"{name}.running").touch()
+    threading.Thread(target=_run, args=(name, seconds, interval, directory), name="profiler", daemon=True).start()
+    return {"profile": name, "pid": os.getpid(), "seconds": seconds, "result": f"/debug/profile/{name}"}
+
+
+def load_profile(name: str) -> Tuple[str, Optional[str]]:
+    """Return ``(status, folded text)``; status is ``done``, ``running`` or ``missing``."""
+    if not _NAME_PATTERN.match(name):
+        return "missing", None
+    directory = profile_dir()
+    try:
+        return "done", (directory / f"{name}.folded").read_text(encoding="utf-8")
+    except FileNotFoundError:
+        pass
+    return ("running" if (directory / f"{name}.running").exists() else "missing"), None
+
@@ -1,25 +1,83 @@
 import json
+import logging
 import os
 import sqlite3
 import threading
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-DEFAULT_DB_PATH = os.getenv("CONVERSATIONS_DB_PATH", os.path.join("data", "conversations.db"))
-os.makedirs(os.path.dirname(DEFAULT_DB_PATH), exist_ok=True)
+from common.config import get_config
+from common.metrics import STORAGE_ERRORS, STORAGE_SECONDS, timed
+from common.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DB_PATH = os.path.join("data", "conversations.db")
+
+UPSERT_CLIENT_SQL = """
+    INSERT INTO clients (channel, user_id, name, phone, profile_json, updated_at)
+    VALUES (:channel, :user_id, :name, :phone, :profile_json, :updated_at)
+    ON CONFLICT(channel, user_id) DO UPDATE SET
+        name=COALESCE(excluded.name, clients.name),
+        phone=COALESCE(excluded.phone, clients.phone),
+        profile_json=COALESCE(excluded.profile_json, clients.profile_json),
+        updated_at=excluded.updated_at
+"""
+INSERT_MESSAGE_SQL = """
+    INSERT INTO messages (channel, user_id, role, content, meta_json, created_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+MESSAGE_INDEXES = {
+    "idx_messages_channel_user": "CREATE INDEX IF NOT EXISTS idx_messages_channel_user ON messages(channel, user_id, id)",
+}
+# Channel message ids (WhatsApp wamid) kept in meta; only bulk imports look them up.
+EXTERNAL_ID_INDEX = "idx_messages_external_id"
+EXTERNAL_ID_LOOKUP_CHUNK = 500
+
+# (channel, user_id, role, content, meta, created_at) as accepted by `import_batch`.
+MessageRow = Tuple[str, str, str, str, Optional[Dict[str, Any]], str]
+
+
+def _observed(method: Callable) -> Callable:
+    timed_method = timed(STORAGE_SECONDS, STORAGE_ERRORS, operation=method.__name__)(method)
+    return traced(f"sqlite.{method.__name__}")(timed_method)
 
 
 class ConversationStorage:
+    # The connection is opened lazily, once per process, so forked workers never share it.
+
     def __init__(self, db_path: Optional[str] = None) -> None:
-        self.db_path = db_path or DEFAULT_DB_PATH
+        self.db_path = db_path or get_config().get("CONVERSATIONS_DB_PATH", DEFAULT_DB_PATH)
         self._lock = threading.Lock()
-        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
-        self._conn.row_factory = sqlite3.Row
-        self._init_schema()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._pid = os.getpid()
 
-    def _init_schema(self) -> None:
-        with self._conn:
-            self._conn.executescript(
+    @contextmanager
+    def _connection(self) -> Iterator[sqlite3.Connection]:
+        if self._pid != os.getpid():
+            # Forked child: the parent's lock state and handle are not ours to use.
+            self._lock = threading.Lock()
+            self._conn = None
+            self._pid = os.getpid()
+
+        with self._lock:
+            if self._conn is None:
+                self._conn = self._connect()
+            yield self._conn
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        self._init_schema(conn)
+        return conn
+
+    def _init_schema(self, conn: sqlite3.Connection) -> None:
+        with conn:
+            conn.executescript(
                 """
                 CREATE TABLE IF NOT EXISTS clients (
                     channel TEXT NOT NULL,
@@ -41,11 +99,19 @@ class ConversationStorage:
                     created_at TEXT NOT NULL
                 );
 
-                CREATE INDEX IF NOT EXISTS idx_messages_channel_user
-                    ON messages(channel, user_id, id);
+                CREATE TABLE IF NOT EXISTS app_state (
+                    kind TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data_json TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (kind, key)
+                );
                 """
             )
+            for statement in MESSAGE_INDEXES.values():
+                conn.execute(statement)
 
+    @_observed
     def save_client(
         self,
         channel: str,
@@ -62,20 +128,10 @@ class ConversationStorage:
             "updated_at": datetime.utcnow().isoformat(),
         }
 
-        with self._lock, self._conn:
-            self._conn.execute(
-                """
-                INSERT INTO clients (channel, user_id, name, phone, profile_json, updated_at)
-                VALUES (:channel, :user_id, :name, :phone, :profile_json, :updated_at)
-                ON CONFLICT(channel, user_id) DO UPDATE SET
-                    name=COALESCE(excluded.name, clients.name),
-                    phone=COALESCE(excluded.phone, clients.phone),
-                    profile_json=COALESCE(excluded.profile_json, clients.profile_json),
-                    updated_at=excluded.updated_at
-                """,
-                {**payload, "channel": channel, "user_id": user_id},
-            )
+        with self._connection() as conn, conn:
+            conn.execute(UPSERT_CLIENT_SQL, {**payload, "channel": channel, "user_id": user_id})
 
+    @_observed
     def add_message(
         self,
         channel: str,
@@ -84,13 +140,10 @@ class ConversationStorage:
         content: str,
         *,
         meta: Optional[Dict[str, Any]] = None,
-    ) -> None:
-        with self._lock, self._conn:
-            self._conn.execute(
-                """
-                INSERT INTO messages (channel, user_id, role, content, meta_json, created_at)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
+    ) -> int:
+        with self._connection() as conn, conn:
+            cursor = conn.execute(
+                INSERT_MESSAGE_SQL,
                 (
                     channel,
                     user_id,
@@ -100,18 +153,27 @@ class ConversationStorage:
                     datetime.utcnow().isoformat(),
                 ),
             )
+        return cursor.lastrowid
 
-    def get_recent_messages(self, channel: str, user_id: str, limit: int = 30) -> List[Dict[str, Any]]:
-        with self._lock:
-            cursor = self._conn.execute(
+    @_observed
+    def get_recent_messages(
+        self,
+        channel: str,
+        user_id: str,
+        limit: int = 30,
+        *,
+        since_id: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        with self._connection() as conn:
+            cursor = conn.execute(
                 """
                 SELECT role, content
                 FROM messages
-                WHERE channel = ? AND user_id = ?
+                WHERE channel = ? AND user_id = ? AND id >= ?
                 ORDER BY id DESC
                 LIMIT ?
                 """,
-                (channel, user_id, limit),
+                (channel, user_id, since_id or 0, limit),
             )
             rows = cursor.fetchall()
 
@@ -120,5 +182,209 @@ class ConversationStorage:
             for row in reversed(rows)
         ]
 
+    @_observed
+    def save_state(self, kind: str, key: str, data: Any) -> None:
+        with self._connection() as conn, conn:
+            conn.execute(
+                """
+                INSERT INTO app_state (kind, key, data_json, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(kind, key) DO UPDATE SET
+                    data_json=excluded.data_json,
+                    updated_at=excluded.updated_at
+                """,
+                (kind, key, json.dumps(data, ensure_ascii=False), datetime.utcnow().isoformat()),
+            )
+
+    @_observed
+    def load_state(self, kind: str, key: str) -> Optional[Any]:
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT data_json FROM app_state WHERE kind = ? AND key = ?",
+                (kind, key),
+            ).fetchone()
+        return json.loads(row["data_json"]) if row else None
+
+    @_observed
+    def load_states(self, kind: str) -> Dict[str, Any]:
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT key, data_json FROM app_state WHERE kind = ?",
+                (kind,),
+            ).fetchall()
+        return {row["key"]: json.loads(row["data_json"]) for row in rows}
+
+    @_observed
+    def delete_state(self, kind: str, key: str) -> None:
+        with self._connection() as conn, conn:
+            conn.execute("DELETE FROM app_state WHERE kind = ? AND key = ?", (kind, key))
+
+    @_observed
+    def prune_states(self, kind: str, older_than: str) -> int:
+        with self._connection() as conn, conn:
+            cursor = conn.execute(
+                "DELETE FROM app_state WHERE kind = ? AND updated_at < ?",
+                (kind, older_than),
+            )
+        return cursor.rowcount
+
+    @_observed
+    def import_batch(self, messages: Iterable[MessageRow], clients: Iterable[Dict[str, Any]] = ()) -> int:
+        """Insert messages and upsert clients (`save_client` fields) in one transaction."""
+        now = datetime.utcnow().isoformat()
+        client_rows = [
+            {
+                "channel": client["channel"],
+                "user_id": client["user_id"],
+                "name": client.get("name"),
+                "phone": client.get("phone"),
+                "profile_json": json.dumps(client["profile"]) if client.get("profile") else None,
+                "updated_at": now,
+            }
+            for client in clients
+        ]
+        message_rows = (
+            (channel, user_id, role, content, json.dumps(meta) if meta else None, created_at)
+            for channel, user_id, role, content, meta, created_at in messages
+        )
+        with self._connection() as conn, conn:
+            conn.executemany(UPSERT_CLIENT_SQL, client_rows)
+            cursor = conn.executemany(INSERT_MESSAGE_SQL, message_rows)
+        return cursor.rowcount
+
+    @_observed
+    def existing_external_ids(self, channel: str, external_ids: Iterable[str]) -> Set[str]:
+        """Those of ``external_ids`` already stored as ``meta["id"]`` in ``channel``."""
+        ids = list(external_ids)
+        found: Set[str] = set()
+        with self._connection() as conn:
+            for start in range(0, len(ids), EXTERNAL_ID_LOOKUP_CHUNK):
+                chunk = ids[start:start + EXTERNAL_ID_LOOKUP_CHUNK]
+                rows = conn.execute(
+                    f"""
+                    SELECT json_extract(meta_json, '$.id') AS external_id
+                    FROM messages
+                    WHERE channel = ? AND json_extract(meta_json, '$.id') IN ({", ".join("?" * len(chunk))})
+                    """,
+                    (channel, *chunk),
+                ).fetchall()
+                found.update(row["external_id"] for row in rows)
+        return found
+
+    def first_message_times(self, channel: str) -> Dict[str, str]:
+        """``created_at`` of the earliest stored message of every user in ``channel``."""
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT user_id, MIN(created_at) AS first_at FROM messages WHERE channel = ? GROUP BY user_id",
+                (channel,),
+            ).fetchall()
+        return {row["user_id"]: row["first_at"] for row in rows}
+
+    @contextmanager
+    def external_id_index(self) -> Iterator[None]:
+        """Index ``meta["id"]`` for `existing_external_ids` while the block runs; the services never need it."""
+        with self._connection() as conn:
+            conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {EXTERNAL_ID_INDEX} "
+                "ON messages(channel, json_extract(meta_json, '$.id'))"
+            )
+        try:
+            yield
+        finally:
+            with self._connection() as conn:
+                conn.execute(f"DROP INDEX IF EXISTS {EXTERNAL_ID_INDEX}")
+
+    @contextmanager
+    def deferred_indexes(self) -> Iterator[None]:
+        """Drop the message indexes and relax fsync for an offline bulk load; restore both afterwards."""
+        with self._connection() as conn:
+            synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+            with conn:
+                for name in MESSAGE_INDEXES:
+                    conn.execute(f"DROP INDEX IF EXISTS {name}")
+            conn.execute("PRAGMA synchronous = OFF")
+        try:
+            yield
+        finally:
+            with self._connection() as conn:
+                conn.execute(f"PRAGMA synchronous = {int(synchronous)}")
+                with conn:
+                    for statement in MESSAGE_INDEXES.values():
+                        conn.execute(statement)
+
+    def iter_messages(
+        self,
+        *,
+        channel: Optional[str] = None,
+        user_id: Optional[str] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+        page_size: int = 1000,
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield messages with their client in id order; ``since`` inclusive, ``until`` exclusive."""
+        # Each page is its own short read, so no long read transaction blocks the writers.
+        conditions = ["m.id > :after"]
+        params: Dict[str, Any] = {"limit": page_size}
+        for column, operator, value in (
+            ("m.channel", "=", channel),
+            ("m.user_id", "=", user_id),
+            ("m.created_at", ">=", since),
+            ("m.created_at", "<", until),
+        ):
+            if value is not None:
+                name = f"p{len(params)}"
+                conditions.append(f"{column} {operator} :{name}")
+                params[name] = value
+        query = f"""
+            SELECT m.id, m.channel, m.user_id, m.role, m.content, m.meta_json, m.created_at,
+                   c.name AS client_name, c.phone AS client_phone
+            FROM messages AS m
+            LEFT JOIN clients AS c ON c.channel = m.channel AND c.user_id = m.user_id
+            WHERE {" AND ".join(conditions)}
+            ORDER BY m.id
+            LIMIT :limit
+        """
+
+        after = 0
+        while True:
+            with self._connection() as conn:
+                rows = conn.execute(query, {**params, "after": after}).fetchall()
+            for row in rows:
+                yield {
+                    "id": row["id"],
+                    "channel": row["channel"],
+                    "user_id": row["user_id"],
+                    "role": row["role"],
+                    "content": row["content"],
+                    "meta": json.loads(row["meta_json"]) if row["meta_json"] else None,
+                    "created_at": row["created_at"],
+                    "client_name": row["client_name"],
+                    "client_phone": row["client_phone"],
+                }
+            if len(rows) < page_size:
+                return
+            after = rows[-1]["id"]
+
+    def is_writable(self) -> bool:
+        """Take (and release) SQLite's write lock without changing anything."""
+        try:
+            with self._connection() as conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.rollback()
+        except (sqlite3.Error, OSError) as exc:
+            logger.error("Database %s is not writable: %s", self.db_path, exc)
+            return False
+        return True
+
+
+_storage: Optional[ConversationStorage] = None
+_storage_lock = threading.Lock()
+
 
-storage = ConversationStorage()
+def get_storage() -> ConversationStorage:
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = ConversationStorage()
+    return _storage
@@ -0,0 +1,180 @@
+"""Sampled per-message tracing; every finished span is one JSON line on the ``trace`` logger."""
+import hmac
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Callable, Dict, Iterator, Optional
+
+from common.config import FALSY_VALUES, get_config
+
+logger = logging.getLogger("trace")
+
+TRACE_HEADER = "X-Trace"
+TRACE_ID_HEADER = "X-Trace-Id"
+TRACE_TOKEN_HEADER = "X-Trace-Token"
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+_handler_lock = threading.Lock()
+_handler_installed = False
+
+
+def _ensure_handler() -> None:
+    # Trace lines are plain JSON, so they get their own handler instead of the service's log format.
+    global _handler_installed
+    if _handler_installed:
+        return
+    with _handler_lock:
+        if _handler_installed:
+            return
+        path = get_config().get("TRACE_LOG_FILE")
+        handler = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        _handler_installed = True
+
+
+class _Trace:
+    __slots__ = ("trace_id", "stages", "lock")
+
+    def __init__(self, trace_id: str) -> None:
+        self.trace_id = trace_id
+        self.stages: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "attributes", "started_at", "_started")
+
+    def __init__(self, trace: _Trace, name: str, parent: Optional["Span"], attributes: Dict[str, Any]) -> None:
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.attributes = attributes
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+
+    @property
+    def trace_id(self) -> str:
+        return self.trace.trace_id
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        duration_ms = round((time.perf_counter() - self._started) * 1000, 3)
+        record: Dict[str, Any] = {
+            "trace_id": self.trace.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.started_at, 6),
+            "duration_ms": duration_ms,
+            "pid": os.getpid(),
+            **self.attributes,
+        }
+        if error is not None:
+            record["error"] = type(error).__name__
+        with self.trace.lock:
+            if self.parent_id is None:
+                record["stages"] = {name: round(total, 3) for name, total in self.trace.stages.items()}
+            else:
+                self.trace.stages[self.name] = self.trace.stages.get(self.name, 0.0) + duration_ms
+        _ensure_handler()
+        logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def parse_trace_header(value: Optional[str]) -> Optional[bool]:
+    """``X-Trace: 1`` forces tracing on, ``X-Trace: 0`` off; anything else defers to the sample rate."""
+    if not value:
+        return None
+    return value.strip().lower() not in FALSY_VALUES
+
+
+def trace_authorized(token: Optional[str]) -> bool:
+    """Whether a caller may force tracing with `TRACE_HEADER`; needs ``TRACE_TOKEN`` to be set."""
+    expected = get_config().get("TRACE_TOKEN")
+    return bool(expected and token and hmac.compare_digest(expected.encode(), token.encode()))
+
+
+def should_sample(forced: Optional[bool] = None) -> bool:
+    if forced is not None:
+        return forced
+    rate = get_config().number("TRACE_SAMPLE_RATE", 0.0)
+    return rate > 0 and random.random() < rate
+
+
+@contextmanager
+def _activate(span: Span) -> Iterator[Span]:
+    token = _current.set(span)
+    try:
+        yield span
+    except BaseException as exc:
+        span.finish(exc)
+        raise
+    else:
+        span.finish()
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def start_trace(
+    name: str,
+    *,
+    sampled: Optional[bool] = None,
+    trace_id: Optional[str] = None,
+    **attributes: Any,
+) -> Iterator[Optional[Span]]:
+    """Open a root span; yields ``None`` when the trace is not sampled."""
+    if not should_sample(sampled):
+        token = _current.set(None)
+        try:
+            yield None
+        finally:
+            _current.reset(token)
+        return
+
+    root = Span(_Trace(trace_id or uuid.uuid4().hex), name, None, attributes)
+    with _activate(root) as active:
+        yield active
+
+
+@contextmanager
+def span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Time a stage of the current trace; does nothing outside a sampled trace."""
+    parent = _current.get()
+    if parent is None:
+        yield None
+        return
+    with _activate(Span(parent.trace, name, parent, attributes)) as child:
+        yield child
+
+
+def traced(name: str) -> Callable:
+    """Decorator form of `span`."""
+
+    def decorator(function: Callable) -> Callable:
+        @wraps(function)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if _current.get() is None:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,79 @@
+"""Measure import time of the service modules and check they have no import side effects.
+
+Usage: python scripts/check_startup.py [--budget-ms 600]
+
+Each module is imported in a fresh interpreter with ``-X importtime`` from an
+empty working directory, so a stray ``mkdir`` or SQLite file shows up as a
+failure. The exit code is non-zero when a module exceeds the budget or leaves
+anything behind.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+from typing import Optional
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+MODULES = ("app.main", "bot.telegram_bot")
+DEFAULT_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "600"))
+
+
+def cumulative_import_us(stderr: str, module: str) -> Optional[int]:
+    # Lines look like: "import time:   self [us] | cumulative | imported package"
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        parts = [part.strip() for part in line[len("import time:"):].split("|")]
+        if len(parts) == 3 and parts[2] == module:
+            return int(parts[1])
+    return None
+
+
+def check_module(module: str, budget_ms: float) -> bool:
+    with tempfile.TemporaryDirectory() as workdir:
+        env = {
+            **os.environ,
+            "PYTHONPATH": str(REPO_ROOT),
+            "CONVERSATIONS_DB_PATH": os.path.join(workdir, "data", "conversations.db"),
+            "CONVERSATION_LOG_DIR": os.path.join(workdir, "conversation_logs"),
+        }
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=workdir,
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        leftovers = sorted(os.listdir(workdir))
+
+    if result.returncode != 0:
+        print(f"FAIL {module}: import raised\n{result.stderr.splitlines()[-1]}")
+        return False
+
+    elapsed_us = cumulative_import_us(result.stderr, module)
+    if elapsed_us is None:
+        print(f"FAIL {module}: no importtime data")
+        return False
+
+    elapsed_ms = elapsed_us / 1000
+    ok = elapsed_ms <= budget_ms and not leftovers
+    status = "ok  " if ok else "FAIL"
+    print(f"{status} {module}: {elapsed_ms:.1f} ms (budget {budget_ms:.0f} ms)")
+    if leftovers:
+        print(f"     import created files: {', '.join(leftovers)}")
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS)
+    args = parser.parse_args()
+
+    results = [check_module(module, args.budget_ms) for module in MODULES]
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,322 @@
+"""Bulk import and export of the conversation history in SQLite.
+
+Usage:
+    python scripts/conversations.py import --format logs conversation_logs/*.jsonl
+    python scripts/conversations.py import --format webhook webhooks.jsonl.gz
+    python scripts/conversations.py export --channel whatsapp --since 2025-01-01 --until 2025-02-01 > january.jsonl
+    python scripts/conversations.py export --user 77001234567 --format csv --output client.csv
+
+Import streams JSON lines (``-`` reads stdin, ``.gz`` files are decompressed)
+and writes them in ``--batch-size`` rows per ``executemany`` transaction, with
+the message index dropped for the duration of the load and rebuilt at the end.
+Formats:
+
+* ``logs``: the bot's ``conversation_logs/*.jsonl`` lines
+  (``user_id``, ``full_name``, ``role``, ``text``, ``timestamp``, …);
+* ``webhook``: raw WhatsApp Cloud API webhook bodies, one per line, as Meta
+  posts them to ``/webhook``; delivery statuses are skipped;
+* ``export``: lines produced by ``export --format jsonl``.
+
+Messages that carry a channel message id (``meta["id"]``, the WhatsApp wamid)
+are skipped when that id is already stored, so webhook and export files can be
+re-imported safely. ``logs`` lines have no such id, but the bot writes every
+line to ``messages`` as well, so a line is skipped when the database already
+has that user's history from that moment on (see `drop_logged`).
+
+Export pages through the ``messages`` table by id (see
+`ConversationStorage.iter_messages`), so memory use does not grow with the
+result and the live services are never locked out for the whole export.
+``--since`` is inclusive, ``--until`` exclusive; dates without an offset are UTC.
+"""
+import argparse
+import csv
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import time
+from contextlib import ExitStack
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from app.main import WHATSAPP_CHANNEL, contact_display_name, extract_plain_text, iter_whatsapp_messages  # noqa: E402
+from bot.telegram_bot import TELEGRAM_CHANNEL  # noqa: E402
+from common.storage import ConversationStorage, MessageRow  # noqa: E402
+
+DEFAULT_BATCH_SIZE = 10_000
+# The bot stamps a log line just before storing the same message, so the two times differ slightly.
+LOG_CLOCK_SKEW = timedelta(seconds=5)
+CSV_FIELDS = ["id", "channel", "user_id", "client_name", "client_phone", "role", "content", "created_at", "meta"]
+
+# (message row, client upsert or None) per imported message.
+Record = Tuple[MessageRow, Optional[Dict[str, Any]]]
+
+
+def open_input(path: str) -> IO[str]:
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def read_json_lines(paths: Iterable[str], stats: Dict[str, int]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        with open_input(path) as handle:
+            for number, line in enumerate(handle, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as exc:
+                    stats["skipped"] += 1
+                    print(f"{path}:{number}: skipped, invalid JSON ({exc})", file=sys.stderr)
+
+
+def _utc_iso(value: str) -> str:
+    """Parse an ISO date/datetime and return it in the stored form: naive UTC isoformat."""
+    moment = datetime.fromisoformat(value)
+    if moment.tzinfo is not None:
+        moment = moment.astimezone(timezone.utc).replace(tzinfo=None)
+    return moment.isoformat()
+
+
+def _epoch_to_iso(value: Any) -> str:
+    try:
+        moment = datetime.fromtimestamp(int(value), timezone.utc)
+    except (TypeError, ValueError):
+        moment = datetime.now(timezone.utc)
+    # Stored timestamps are naive UTC, like datetime.utcnow().isoformat() in ConversationStorage.
+    return moment.replace(tzinfo=None).isoformat()
+
+
+def records_from_logs(entries: Iterable[Dict[str, Any]], stats: Dict[str, int]) -> Iterator[Record]:
+    for entry in entries:
+        user_id, text = entry.get("user_id"), entry.get("text")
+        try:
+            created_at = _utc_iso(entry["timestamp"]) if entry.get("timestamp") else datetime.utcnow().isoformat()
+        except (TypeError, ValueError):
+            created_at = None
+        if user_id is None or not text or created_at is None:
+            stats["skipped"] += 1
+            continue
+        role = "assistant" if entry.get("role") == "bot" else entry.get("role", "user")
+        meta = {"conversation_id": entry["conversation_id"]} if entry.get("conversation_id") else None
+        client = {
+            "channel": TELEGRAM_CHANNEL,
+            "user_id": str(user_id),
+            "name": entry.get("full_name"),
+            "profile": {"username": entry.get("username")},
+        }
+        yield (TELEGRAM_CHANNEL, str(user_id), role, text, meta, created_at), client
+
+
+def records_from_webhooks(payloads: Iterable[Dict[str, Any]], stats: Dict[str, int]) -> Iterator[Record]:
+    for payload in payloads:
+        for contact, message in iter_whatsapp_messages(payload):
+            sender_id = message.get("from", "unknown")
+            text = extract_plain_text(message) or f"[{message.get('type', 'unknown')} message]"
+            client = {
+                "channel": WHATSAPP_CHANNEL,
+                "user_id": sender_id,
+                "name": contact_display_name(contact),
+                "phone": sender_id,
+                "profile": contact,
+            }
+            row = (WHATSAPP_CHANNEL, sender_id, "user", text, message, _epoch_to_iso(message.get("timestamp")))
+            yield row, client
+
+
+def records_from_export(entries: Iterable[Dict[str, Any]], stats: Dict[str, int]) -> Iterator[Record]:
+    for entry in entries:
+        try:
+            row = (
+                entry["channel"],
+                str(entry["user_id"]),
+                entry["role"],
+                entry["content"],
+                entry.get("meta"),
+                _utc_iso(entry["created_at"]),
+            )
+        except (KeyError, TypeError, ValueError):
+            stats["skipped"] += 1
+            continue
+        client = None
+        if entry.get("client_name") or entry.get("client_phone"):
+            client = {
+                "channel": row[0],
+                "user_id": row[1],
+                "name": entry.get("client_name"),
+                "phone": entry.get("client_phone"),
+            }
+        yield row, client
+
+
+IMPORT_FORMATS = {
+    "logs": records_from_logs,
+    "webhook": records_from_webhooks,
+    "export": records_from_export,
+}
+# Formats whose rows can carry meta["id"], checked by `drop_known`.
+ID_FORMATS = {"webhook", "export"}
+
+
+def _external_id(row: MessageRow) -> Optional[str]:
+    meta = row[4]
+    return meta.get("id") if isinstance(meta, dict) else None
+
+
+def drop_known(batch: List[Record], storage: ConversationStorage, stats: Dict[str, int]) -> List[Record]:
+    """Remove messages whose channel message id is already stored or repeats earlier in the batch."""
+    wanted: Dict[str, Set[str]] = {}
+    for row, _ in batch:
+        external_id = _external_id(row)
+        if external_id:
+            wanted.setdefault(row[0], set()).add(external_id)
+    seen = {
+        (channel, external_id)
+        for channel, ids in wanted.items()
+        for external_id in storage.existing_external_ids(channel, ids)
+    }
+
+    kept = []
+    for row, client in batch:
+        external_id = _external_id(row)
+        if external_id:
+            if (row[0], external_id) in seen:
+                stats["duplicates"] += 1
+                continue
+            seen.add((row[0], external_id))
+        kept.append((row, client))
+    return kept
+
+
+def drop_logged(records: Iterable[Record], first_times: Dict[str, str], stats: Dict[str, int]) -> Iterator[Record]:
+    """Skip log lines the bot has already stored: those from a user's first stored message onwards."""
+    cutoffs = {
+        user_id: (datetime.fromisoformat(first_at) - LOG_CLOCK_SKEW).isoformat()
+        for user_id, first_at in first_times.items()
+    }
+    for row, client in records:
+        cutoff = cutoffs.get(row[1])
+        if cutoff is not None and row[5] >= cutoff:
+            stats["duplicates"] += 1
+            continue
+        yield row, client
+
+
+def run_import(args: argparse.Namespace) -> int:
+    storage = ConversationStorage(args.db)
+    stats = {"messages": 0, "skipped": 0, "duplicates": 0}
+    records = IMPORT_FORMATS[args.format](read_json_lines(args.files, stats), stats)
+    if args.format == "logs":
+        records = drop_logged(records, storage.first_message_times(TELEGRAM_CHANNEL), stats)
+    started = time.monotonic()
+
+    with ExitStack() as stack:
+        stack.enter_context(storage.deferred_indexes())
+        if args.format in ID_FORMATS:
+            stack.enter_context(storage.external_id_index())
+        while True:
+            batch: List[Record] = list(itertools.islice(records, args.batch_size))
+            if not batch:
+                break
+            batch = drop_known(batch, storage, stats)
+            clients: Dict[Tuple[str, str], Dict[str, Any]] = {}
+            for _, client in batch:
+                if client is not None:
+                    # Later lines win, as they would with one save_client call per message.
+                    clients[(client["channel"], client["user_id"])] = client
+            stats["messages"] += storage.import_batch((row for row, _ in batch), clients.values())
+            elapsed = time.monotonic() - started
+            print(
+                f"{stats['messages']} messages imported ({stats['messages'] / elapsed:.0f}/s)",
+                file=sys.stderr,
+                flush=True,
+            )
+        print("Rebuilding indexes…", file=sys.stderr, flush=True)
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Done: {stats['messages']} messages in {elapsed:.1f}s, {stats['skipped']} lines skipped, "
+        f"{stats['duplicates']} already stored.",
+        file=sys.stderr,
+    )
+    return 0
+
+
+def _date_bound(value: Optional[str]) -> Optional[str]:
+    if value is None:
+        return None
+    try:
+        return _utc_iso(value)
+    except ValueError:
+        raise SystemExit(f"Not an ISO date or datetime: {value!r}")
+
+
+def run_export(args: argparse.Namespace) -> int:
+    if not os.path.exists(args.db):
+        raise SystemExit(f"Database {args.db} does not exist")
+    storage = ConversationStorage(args.db)
+    messages = storage.iter_messages(
+        channel=args.channel,
+        user_id=args.user,
+        since=_date_bound(args.since),
+        until=_date_bound(args.until),
+        page_size=args.page_size,
+    )
+
+    output = open(args.output, "w", encoding="utf-8", newline="") if args.output else sys.stdout
+    count = 0
+    try:
+        if args.format == "csv":
+            writer = csv.DictWriter(output, fieldnames=CSV_FIELDS)
+            writer.writeheader()
+            for message in messages:
+                meta = message["meta"]
+                writer.writerow({**message, "meta": json.dumps(meta, ensure_ascii=False) if meta else ""})
+                count += 1
+        else:
+            for message in messages:
+                output.write(json.dumps(message, ensure_ascii=False) + "\n")
+                count += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f"{count} messages exported.", file=sys.stderr)
+    return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Bulk import/export of stored conversations")
+    parser.add_argument("--db", help="SQLite file (default: CONVERSATIONS_DB_PATH or data/conversations.db)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    importer = commands.add_parser("import", help="load JSON lines into the database")
+    importer.add_argument("files", nargs="+", help="JSONL files, optionally .gz; '-' for stdin")
+    importer.add_argument("--format", choices=sorted(IMPORT_FORMATS), required=True)
+    importer.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="rows per transaction")
+
+    exporter = commands.add_parser("export", help="stream messages out as JSONL or CSV")
+    exporter.add_argument("--channel", help="whatsapp or telegram")
+    exporter.add_argument("--user", help="user id within the channel")
+    exporter.add_argument("--since", help="ISO date/datetime, inclusive; UTC unless it has an offset")
+    exporter.add_argument("--until", help="ISO date/datetime, exclusive; UTC unless it has an offset")
+    exporter.add_argument("--format", choices=["jsonl", "csv"], default="jsonl")
+    exporter.add_argument("--output", help="file to write (default: stdout)")
+    exporter.add_argument("--page-size", type=int, default=1000, help="rows fetched per query")
+
+    args = parser.parse_args()
+    if args.db is None:
+        args.db = ConversationStorage().db_path
+    return run_import(args) if args.command == "import" else run_export(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -17,14 +17,15 @@ fi
 echo "==> Restarting services via systemd..."
 # Убиваем процессы - systemd автоматически перезапустит их (Restart=on-failure)
 # Используем pkill с опцией -TERM для graceful shutdown
-pkill -TERM -f "gunicorn.*app.main:app" && echo "Sent TERM to gunicorn" || echo "No gunicorn found"
+pkill -TERM -f "gunicorn.*app.main" && echo "Sent TERM to gunicorn" || echo "No gunicorn found"
 pkill -TERM -f "python.*bot/telegram_bot.py" && echo "Sent TERM to telegram bot" || echo "No telegram bot found"
+pkill -TERM -f "python.*common.llm serve" && echo "Sent TERM to LLM gateway" || echo "No LLM gateway found"
 
 echo "==> Waiting for systemd to restart services..."
 sleep 5
 
 echo "==> Checking service status..."
-if pgrep -f "gunicorn.*app:app" > /dev/null; then
+if pgrep -f "gunicorn.*app.main" > /dev/null; then
     echo "✓ WhatsApp webhook is running"
 else
     echo "⚠ WhatsApp webhook not detected (may still be starting)"
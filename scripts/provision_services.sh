@@ -6,25 +6,53 @@ APP_USER="${APP_USER:-ubuntu}"
 SERVER_NAME="${SERVER_NAME:-bot.smetai.online}"
 APP_PORT="${APP_PORT:-8080}"
 VENV_PATH="${VENV_PATH:-${APP_DIR}/venv}"
+# One webhook may wait LLM_QUEUE_TIMEOUT, call OpenRouter (30s) and Telegram/WhatsApp (10-15s each).
+GUNICORN_TIMEOUT="${GUNICORN_TIMEOUT:-90}"
 
 UNIT_DIR="/etc/systemd/system"
 WEBHOOK_UNIT="${UNIT_DIR}/whatsapp-webhook.service"
 LEADBOT_UNIT="${UNIT_DIR}/telegram-leadbot.service"
+GATEWAY_UNIT="${UNIT_DIR}/llm-gateway.service"
 NGINX_CONF="/etc/nginx/sites-available/whatsapp"
 NGINX_LINK="/etc/nginx/sites-enabled/whatsapp"
+# The shared gateway is only needed when the services are pointed at its socket.
+LLM_GATEWAY_SOCKET="${LLM_GATEWAY_SOCKET:-$(grep -E '^LLM_GATEWAY_SOCKET=' "${APP_DIR}/.env" 2>/dev/null | tail -n 1 | cut -d= -f2-)}"
 
 echo "[provision] configuring systemd units for ${APP_DIR}"
+if [ -n "${LLM_GATEWAY_SOCKET}" ]; then
+sudo tee "${GATEWAY_UNIT}" >/dev/null <<EOF
+[Unit]
+Description=Shared OpenRouter gateway (used when LLM_GATEWAY_SOCKET is set)
+After=network.target
+
+[Service]
+Type=simple
+User=${APP_USER}
+WorkingDirectory=${APP_DIR}
+Environment="PYTHONUNBUFFERED=1"
+ExecStart=${VENV_PATH}/bin/python -m common.llm serve
+Restart=on-failure
+
+[Install]
+WantedBy=multi-user.target
+EOF
+else
+    echo "[provision] LLM_GATEWAY_SOCKET is not set; removing the llm-gateway unit"
+    sudo systemctl disable --now llm-gateway >/dev/null 2>&1 || true
+    sudo rm -f "${GATEWAY_UNIT}"
+fi
+
 sudo tee "${WEBHOOK_UNIT}" >/dev/null <<EOF
 [Unit]
 Description=WhatsApp webhook (gunicorn)
-After=network.target
+After=network.target llm-gateway.service
 
 [Service]
 Type=simple
 User=${APP_USER}
 WorkingDirectory=${APP_DIR}
 Environment="PYTHONUNBUFFERED=1"
-ExecStart=${VENV_PATH}/bin/gunicorn -b 127.0.0.1:${APP_PORT} app.main:app
+ExecStart=${VENV_PATH}/bin/gunicorn --preload --timeout ${GUNICORN_TIMEOUT} -b 127.0.0.1:${APP_PORT} 'app.main:create_app()'
 Restart=on-failure
 
 [Install]
@@ -34,7 +62,7 @@ EOF
 sudo tee "${LEADBOT_UNIT}" >/dev/null <<EOF
 [Unit]
 Description=Telegram lead bot
-After=network.target
+After=network.target llm-gateway.service
 
 [Service]
 Type=simple
@@ -51,6 +79,9 @@ EOF
 echo "[provision] reloading systemd daemon"
 sudo systemctl daemon-reload
 sudo systemctl enable whatsapp-webhook telegram-leadbot >/dev/null 2>&1 || true
+if [ -n "${LLM_GATEWAY_SOCKET}" ]; then
+    sudo systemctl enable llm-gateway >/dev/null 2>&1 || true
+fi
 
 echo "[provision] configuring nginx for ${SERVER_NAME}"
 sudo tee "${NGINX_CONF}" >/dev/null <<EOF
@@ -59,6 +90,15 @@ server {
     listen [::]:80;
     server_name ${SERVER_NAME};
 
+    # Metrics, readiness and the profiler are for the host only, not the internet.
+    location ~ ^/(metrics|healthz|debug/.*)$ {
+        allow 127.0.0.1;
+        allow ::1;
+        deny all;
+        proxy_pass http://127.0.0.1:${APP_PORT};
+        proxy_set_header Host \$host;
+    }
+
     location / {
         proxy_pass http://127.0.0.1:${APP_PORT};
         proxy_http_version 1.1;
@@ -75,6 +115,9 @@ sudo nginx -t
 sudo systemctl reload nginx
 
 echo "[provision] restarting application services"
+if [ -n "${LLM_GATEWAY_SOCKET}" ]; then
+    sudo systemctl restart llm-gateway
+fi
 sudo systemctl restart whatsapp-webhook
 sudo systemctl restart telegram-leadbot
 